@@ -8,13 +8,13 @@ from typing import Generator, List, Dict, Any, Tuple
 from contextlib import suppress
 
 from tool.config import Config
-from tool.util import log_dbg, log_err, log_info, make_context_messages
+from tool.util import log_dbg, log_err, log_info, log_set_level, make_context_messages
 from core.aimi_plugin import Bot, ChatBot, ChatBotType, BotAskData, make_history
 from app.app_qq import AppQQ
 from app.app_web import AppWEB
 
 from tool.md2img import Md
-from core.memory import Memory
+from core.memory import MemorySpace
 from core.session import Session
 
 
@@ -135,7 +135,7 @@ class Aimi:
     bot_path: str
     config: Config
     md: Md
-    memory: Memory
+    memory: MemorySpace
     task_setting: Dict = {}
     web_setting: Dict = {}
     app_web: AppWEB
@@ -153,7 +153,7 @@ class Aimi:
         self.__load_setting()
         self.config = Config()
         self.md = Md(self.run_path)
-        self.memory = Memory()
+        self.memory = MemorySpace()
 
         self.__session = Session(self.__session_setting)
 
@@ -312,8 +312,14 @@ class Aimi:
                 api_type = self.__get_api_type_by_question(session_id, question)
                 self.session.set_previous_api_type(session_id, api_type)
 
+                # 记忆按 QQ 群/用户分开
+                if self.app_qq.is_group(msg):
+                    memory_key = f"qq_group_{self.app_qq.get_group_id(msg)}"
+                else:
+                    memory_key = f"qq_user_{self.app_qq.get_user_id(msg)}"
+
                 code = 0
-                for answer in self.ask(session_id, ask_data):
+                for answer in self.ask(session_id, ask_data, memory_key):
                     code = answer["code"]
 
                     message = answer["message"][len(reply) :]
@@ -470,9 +476,11 @@ class Aimi:
             }
 
     def ask(
-        self, session_id: str, ask_data: BotAskData
+        self, session_id: str, ask_data: BotAskData, memory_key: str = ""
     ) -> Generator[dict, None, None]:
+        memory = None
         try:
+            memory = self.memory.acquire(memory_key if memory_key else session_id)
             question = ask_data.question
             api_type = self.__get_api_type_by_question(session_id, question)
             self.session.set_previous_api_type(session_id, api_type)
@@ -484,7 +492,9 @@ class Aimi:
                     ask_data.preset = preset
                     log_dbg(f"use type: {api_type} preset")
 
-            talk_history = self.memory.search(question, self.max_link_think)
+            talk_history = memory.search(
+                question, self.max_link_think, ask_data.model
+            )
             ask_data.messages = make_context_messages(question, preset, talk_history)
 
             history = make_history(talk_history)
@@ -501,12 +511,16 @@ class Aimi:
 
                 # save self.memory
                 if message["code"] == 0:
-                    self.memory.append(q=question, a=message["message"])
+                    memory.append(q=question, a=message["message"])
 
                 yield message
         except Exception as e:
             log_err(f"fail to ask: {e}")
             yield f"Error: {e}"
+        finally:
+            # 回答完才放开分区, 中途不会被淘汰
+            if memory:
+                self.memory.release(memory)
 
     def __post_question(
         self, session_id: str, api_type: str, ask_data: BotAskData
@@ -595,6 +609,12 @@ class Aimi:
             return
         self.setting = setting
 
+        try:
+            log_set_level(setting["log_level"])
+        except Exception as e:
+            log_err(f"fail to load aimi log_level: {e}")
+            log_set_level("info")
+
         try:
             self.aimi_name = setting["name"]
         except Exception as e:
@@ -690,7 +710,7 @@ class Aimi:
         log_info("now exit aimi.")
         self.notify_offline()
         
-        if self.memory.save_memory():
+        if self.memory.save_memory(sync=True):
             log_info("exit: save self.memory done.")
         else:
             log_err("exit: fail to save self.memory.")
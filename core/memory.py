@@ -1,8 +1,18 @@
 import os
-from typing import List, Union, Any, Dict
+import re
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Union, Any, Dict, Tuple, Generator
 
 from tool.config import Config
 from tool.util import log_dbg, log_err, log_info, write_yaml
+from tool.token_count import count_tokens, encoding_name, MESSAGE_TOKEN_OVERHEAD
+from tool.simhash import SimHashIndex, simhash
+from tool.ring_buffer import TalkItem, TalkRing
+from tool.bm25 import BM25Index
 
 
 class Memory:
@@ -10,53 +20,212 @@ class Memory:
     memory_model_type: str = "transformers"
     meomry_model_file: str = ""
     model_enable: bool = False
-    idx: int = 0
     size: int = 1024
-    pool: List[dict] = []
+    pool: TalkRing
     memory_model: Any
     memory_model_depth: int = 20
     memory_has_change: bool = True
+    journal_file: str = ""
+    journal_count: int = 0
+    journal_compact_size: int = 256
+    journal_conversation_id: str = ""
+    partition: str = ""
+    memory_config: str = ""
+    memory_vector_file: str = ""
+    train_scheduler: Any = None
+
+    def __init__(self, partition: str = ""):
+        self.__setting = {}
+        self.__journal_fp = None
+        self.__journal_lock = threading.Lock()
+        self.__compact_thread = None
+        self.__model_lock = threading.Lock()
+        self.__model_loaded = threading.Event()
+        # 同一个分区可能被多个线程同时写, 查重/槽位/索引要一起改
+        self.__append_lock = threading.Lock()
+        self.__model_state = "none"
+        self.__pending_slots: List[int] = []
+        self.__dedup_index = None
+        self.__lexical_index = None
+        # 重复记忆不占新槽位, 只记下刷新时已经写入了多少条, 用来算 age
+        self.__touched: Dict[int, int] = {}
+        self.__writes = 0
+
+        self.partition = partition
+        if partition:
+            self.memory_config = f"{Config.memory_path}/{partition}/memory.yml"
+            self.journal_file = f"{Config.memory_path}/{partition}/memory.journal"
+            self.memory_vector_file = f"{Config.memory_path}/{partition}/memory.vec"
+        else:
+            self.memory_config = Config.memory_config
+            self.journal_file = Config.memory_journal
+            self.memory_vector_file = Config.memory_vector_file
 
-    def __init__(self):
         self.__load_memory()
+        self.__text_bytes = sum(self.__item_bytes(item) for item in self.pool)
+        self.__token_encoding = ""
+        self.__token_len = [None] * self.size
+
+        if self.memory_model_type == "transformers" and partition:
+            # 每个分区各自加载一个 DistilBERT 太重了, 分区只支持 vector.
+            log_dbg(f"partition {partition} skip transformers memory model")
+            self.__model_loaded.set()
+        elif self.memory_model_type in ["transformers", "vector"]:
+            # torch/transformers 导入和建索引都很慢, 放到后台, 没好之前 search 只用历史记录.
+            self.__model_state = "loading"
+            loader = threading.Thread(target=self.__load_model_background)
+            loader.setDaemon(True)
+            loader.start()
+        else:
+            self.__model_loaded.set()
+
+    @property
+    def model_state(self) -> str:
+        """
+        none: 没有配置记忆模型
+        loading: 后台加载中
+        warming: 已加载, 还在等权重 (transformers 第一次训练)
+        ready: 可以召回
+        failed: 加载失败
+        """
+        if self.__model_state != "loaded":
+            return self.__model_state
+        if self.memory_model.enable:
+            return "ready"
+        return "warming"
+
+    def model_ready(self) -> bool:
+        return self.model_enable and self.memory_model.enable
+
+    def wait_model(self, timeout: Union[float, None] = None) -> bool:
+        return self.__model_loaded.wait(timeout)
+
+    def __make_transformers(self):
+        from tool.transformer import Transformers
+        from tool.train_scheduler import TrainScheduler
 
-        if self.memory_model_type == "transformers":
-            try:
-                from tool.transformer import Transformers
+        try:
+            max_batch_size = int(self.__setting["memory_predict_batch_size"])
+        except:
+            max_batch_size = 8
+        try:
+            batch_wait_ms = int(self.__setting["memory_predict_batch_wait_ms"])
+        except:
+            batch_wait_ms = 5
 
-                self.memory_model = Transformers()
-                self.model_enable = True
-            except Exception as e:
-                log_err(f"fail to load Transformers: {e}")
-                self.memory_model = None
-                self.model_enable = False
+        try:
+            quantize = bool(self.__setting["memory_model_quantize"])
+        except:
+            quantize = False
+        try:
+            threads = int(self.__setting["memory_model_threads"])
+        except:
+            threads = 0
+
+        model = Transformers(max_batch_size, batch_wait_ms, quantize, threads)
+        self.train_scheduler = TrainScheduler(
+            model,
+            lambda: self.pool,
+            self.memory_model_file,
+            self.__setting,
+        )
+        return model
+
+    def __make_vector(self):
+        from tool.vector_recall import VectorRecall
+
+        try:
+            dtype = self.__setting["memory_vector_dtype"] or "float32"
+        except:
+            dtype = "float32"
+        try:
+            ann_min = int(self.__setting["memory_vector_ann_min"])
+        except:
+            ann_min = 20000
+        try:
+            nprobe = int(self.__setting["memory_vector_nprobe"])
+        except:
+            nprobe = 16
+
+        model = VectorRecall(
+            self.size,
+            store_file=self.memory_vector_file,
+            dtype=dtype,
+            ann_min=ann_min,
+            nprobe=nprobe,
+        )
+        model.train(self.pool)
+        return model
+
+    def __load_model_background(self):
+        start = time.time()
+        try:
+            if self.memory_model_type == "transformers":
+                model = self.__make_transformers()
+            else:
+                model = self.__make_vector()
+        except Exception as e:
+            log_err(f"fail to load memory model {self.memory_model_type}: {e}")
+            self.memory_model = None
+            self.__model_state = "failed"
+            self.__model_loaded.set()
+            return
+
+        with self.__model_lock:
+            # 加载期间新增的记忆补进去
+            for slot in self.__pending_slots:
+                if self.pool[slot]:
+                    model.append(slot, self.pool[slot])
+                    if self.train_scheduler:
+                        self.train_scheduler.notify(slot)
+            self.__pending_slots = []
+            self.memory_model = model
+            self.model_enable = True
+            self.__model_state = "loaded"
+
+        self.__model_loaded.set()
+        log_info(
+            f"memory model {self.memory_model_type} loaded: {time.time() - start:.2f}s"
+        )
 
     def __load_memory(self):
-        mem = Config.load_memory()
+        mem = Config.load_memory(self.memory_config)
         try:
-            self.pool = mem["pool"]
+            pool = mem["pool"] or []
         except:
-            self.pool = []
+            pool = []
         try:
             self.openai_conversation_id = mem["openai_conversation_id"]
         except:
             self.openai_conversation_id = ""
         try:
-            self.idx = mem["idx"]
+            idx = mem["idx"]
         except:
-            self.idx = 0
+            idx = 0
+        try:
+            # 快照里存的是刷新时相对快照的写入位置 (<= 0), 之后回放日志从 0 开始计数
+            self.__touched = {int(slot): int(pos) for slot, pos in (mem["touch"] or {}).items()}
+        except:
+            self.__touched = {}
 
         setting = {}
         try:
             setting = Config.load_setting("aimi")
+            self.__setting = setting
         except Exception as e:
             log_err(f"fail to load memory: {str(e)}")
+            self.pool = TalkRing.from_list(pool, self.size, idx)
             return False
 
         try:
             self.size = setting["memory_size"]
         except:
             self.size = 1024
+        if self.partition:
+            try:
+                self.size = setting["memory_partition_size"]
+            except:
+                self.size = 1024
         try:
             self.memory_model_type = setting["memory_model"]
         except:
@@ -69,151 +238,376 @@ class Memory:
         except:
             self.memory_model_depth = 20
 
-        if len(self.pool) < self.size:
-            self.pool.extend([None] * (self.size - len(self.pool)))
-        if self.idx > self.size:
-            self.idx = 0
+        try:
+            self.journal_compact_size = setting["memory_journal_compact"]
+        except:
+            self.journal_compact_size = 256
 
-        # fix pool idx
-        end_idx = 0
-        for talk_item in reversed(self.pool):
-            if not talk_item:
-                end_idx += 1
-                continue
-            break
+        try:
+            self.rank = setting["memory_rank"] or "hybrid"
+        except:
+            self.rank = "hybrid"
+        try:
+            self.rank_half_life = float(setting["memory_rank_half_life"])
+        except:
+            self.rank_half_life = 8
+        try:
+            self.rank_recent_weight = float(setting["memory_rank_recent_weight"])
+        except:
+            self.rank_recent_weight = 1.0
+        self.rank_recent_limit = max(1, int(4 * self.rank_half_life))
+        self.rank_lexical_limit = 32
 
-        shold_idx = self.size - end_idx
-        log_dbg("shold_idx: " + str(shold_idx))
-        log_dbg("idx: " + str(self.idx))
-        if shold_idx != self.idx:
-            log_info("idx:{} fix to {}".format(self.idx, shold_idx))
-            self.idx = shold_idx
+        try:
+            self.dedup = setting["memory_dedup"]
+        except:
+            self.dedup = True
+        try:
+            self.dedup_distance = int(setting["memory_dedup_distance"])
+        except:
+            self.dedup_distance = 3
+
+        self.pool = TalkRing.from_list(pool, self.size, idx)
+
+        self.__replay_journal()
+
+        # fix pool idx, 回放后的 head 是可信的, 只有对不上时才修正.
+        head = self.pool.head
+        log_dbg("idx: " + str(head))
+        if self.pool.fix_head() != head:
+            log_info("idx:{} fix to {}".format(head, self.pool.head))
 
         log_dbg("conv_id: " + str(self.openai_conversation_id))
-        log_dbg("size: " + str(self.size))
+        log_dbg("size: " + str(self.size) + ", used: " + str(self.pool.count))
+
+    def __replay_journal(self):
+        # 上次压缩没完成的日志也要回放, 按槽位覆盖写, 重复回放没有影响.
+        replay = 0
+        for journal_file in [self.journal_file + ".compact", self.journal_file]:
+            for record in Config.load_memory_journal(journal_file):
+                if "openai_conversation_id" in record:
+                    self.openai_conversation_id = record["openai_conversation_id"]
+                    continue
+
+                if "touch" in record:
+                    # 重复记忆刷新成最新, head 不动
+                    slot = record["touch"]
+                    if 0 <= slot < self.size and self.pool[slot]:
+                        self.__touched[slot] = self.__writes
+                        replay += 1
+                    continue
+
+                slot = record.get("slot", -1)
+                if slot < 0 or slot >= self.size:
+                    continue
+                self.pool.put(slot, TalkItem(record["q"], record["a"], record.get("idx", slot)))
+                self.pool.head = self.pool.next_slot(slot)
+                self.__touched.pop(slot, None)
+                self.__writes += 1
+                replay += 1
+
+        self.journal_count = replay
+        self.journal_conversation_id = self.openai_conversation_id
+        if replay:
+            log_info(f"replay memory journal: {replay}")
+
+    def __journal_write(self, record: dict) -> bool:
+        try:
+            with self.__journal_lock:
+                if not self.__journal_fp:
+                    save_dir = os.path.dirname(self.journal_file)
+                    if save_dir != "." and not os.path.exists(save_dir):
+                        os.makedirs(save_dir)
+                    self.__journal_fp = open(self.journal_file, "a", encoding="utf-8")
+
+                self.__journal_fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self.__journal_fp.flush()
+                self.journal_count += 1
+            return True
+        except Exception as e:
+            log_err(f"fail to write memory journal: {e}, file: {self.journal_file}")
+            return False
+
+    def __compact_journal(self, save_obj: dict, compact_file: str):
+        save_path = self.memory_config
+        tmp_path = save_path + ".tmp"
+        try:
+            write_yaml(tmp_path, save_obj)
+            os.replace(tmp_path, save_path)
+            if os.path.exists(compact_file):
+                os.remove(compact_file)
+            log_info("compact memory done: " + str(save_path))
+        except Exception as e:
+            # 失败时保留 .compact, 下次启动会继续回放.
+            log_err("fail to compact memory: {}, file:{}".format(str(e), save_path))
+
+    def save_memory(self, sync: bool = False) -> bool:
+        if self.openai_conversation_id != self.journal_conversation_id:
+            self.journal_conversation_id = self.openai_conversation_id
+            self.__journal_write({"openai_conversation_id": self.openai_conversation_id})
 
-    def save_memory(self) -> bool:
         if not self.memory_has_change:
             return True
-        save_path = Config.memory_config
 
+        if self.__compact_thread and self.__compact_thread.is_alive():
+            if not sync:
+                return True
+            self.__compact_thread.join()
+
+        if not sync and self.journal_count < self.journal_compact_size:
+            # 新记忆已经写进日志了, 数量不多的时候不需要重写快照.
+            return True
+
+        compact_file = self.journal_file + ".compact"
         try:
-            save_dir = os.path.dirname(save_path)
+            save_dir = os.path.dirname(self.memory_config)
             if save_dir != "." and not os.path.exists(save_dir):
                 os.makedirs(save_dir)
 
-            save_obj = {
-                "openai_conversation_id": self.openai_conversation_id,
-                "idx": self.idx,
-                "pool": self.pool,
-            }
-
-            write_yaml(save_path, save_obj)
+            with self.__append_lock, self.__journal_lock:
+                # 上次压缩失败留下的日志先合并过来, 不能被覆盖掉.
+                if self.__journal_fp:
+                    self.__journal_fp.close()
+                    self.__journal_fp = None
+                if os.path.exists(self.journal_file):
+                    with open(self.journal_file, "r", encoding="utf-8") as src, open(
+                        compact_file, "a", encoding="utf-8"
+                    ) as dst:
+                        dst.write(src.read())
+                    os.remove(self.journal_file)
+
+                save_obj = {
+                    "openai_conversation_id": self.openai_conversation_id,
+                    "idx": self.pool.head,
+                    "pool": self.pool.to_list(),
+                    "touch": {
+                        slot: pos - self.__writes for slot, pos in self.__touched.items()
+                    },
+                }
+                self.journal_count = 0
+                self.memory_has_change = False
+        except Exception as e:
+            log_err(f"fail to rotate memory journal: {e}, file: {self.journal_file}")
+            return False
 
-            log_info("save memory done: " + str(save_path))
-            ret = True
-            self.memory_has_change = False
+        self.__compact_thread = threading.Thread(
+            target=self.__compact_journal, args=(save_obj, compact_file)
+        )
+        self.__compact_thread.start()
+        if sync:
+            self.__compact_thread.join()
 
-        except Exception as e:
-            log_err("fail to save memory: {}, file:{}".format(str(e), save_path))
-            ret = False
+        if self.model_enable and self.memory_model_type == "vector":
+            # 向量在映射文件里, 跟着快照一起刷盘, 下次启动直接映射.
+            try:
+                self.memory_model.save_model(self.memory_vector_file)
+            except Exception as e:
+                log_err(f"fail to save vector store: {e}, file: {self.memory_vector_file}")
 
         # ret |= self.__save_model()
 
-        return ret
-
-    def __get_memory(self, question: str) -> Union[str, List[dict]]:
-        valid_talk_items: List[dict] = []
+        return True
 
-        range_target = self.idx
+    def close(self):
+        with self.__journal_lock:
+            if self.__journal_fp:
+                self.__journal_fp.close()
+                self.__journal_fp = None
 
-        # add history right
-        for talk_item in self.pool[range_target:]:
-            if talk_item:
-                valid_talk_items.append(talk_item)
-        # add history left
-        for talk_item in self.pool[:range_target]:
-            if talk_item:
-                valid_talk_items.append(talk_item)
+    @staticmethod
+    def __item_bytes(item: TalkItem) -> int:
+        if not item:
+            return 0
+        return 2 * (len(item.q) + len(item.a)) + 160
 
-        return valid_talk_items
+    def resident_bytes(self) -> int:
+        # 粗略估算常驻内存: 文本 + 每条记录的容器开销 + 召回矩阵, 文本部分在 append 时增量维护.
+        used = 8 * self.size + self.__text_bytes
+        if self.model_enable and hasattr(self.memory_model, "matrix"):
+            used += self.memory_model.matrix.nbytes
+        return used
 
     def dream(self):
+        self.__model_loaded.wait()
+        if self.memory_model_type == "vector":
+            # 向量召回在加载时已经建好了, 不需要训练.
+            return True
+
+        if self.train_scheduler:
+            # 训练在独立进程里按需进行, 这里只负责启动调度.
+            self.train_scheduler.start()
+            log_info("start dream scheduler")
+            return True
+
         ret = self.__train_model()
         log_info("have a dream done")
         return ret
 
-    def search(self, question: str, max_size: int = 1024) -> str:
-        history = ""
-
-        # use memory_model
-        talk_history: List[Dict] = []
-        talk_history_append = 0
-
-        def qa_dict_to_list(pool_qa, talk_list, talk_list_append, max_size=max_size):
-            for item in pool_qa:
-                q = item.get("q", None)
-                a = item.get("a", None)
-                if q and a:
-                    talk_prefix = "0 我说:“”\n"
-                    append_len = (
-                        len(str(talk_list))
-                        + len(q)
-                        + len(a)
-                        + 2 * len(talk_prefix)
-                        + len(question)
-                    )
-
-                    log_dbg("now len: " + str(append_len))
-
-                    if append_len > max_size:
-                        log_dbg(
-                            "replay over limit. now openai_input len: "
-                            + str(append_len)
-                        )
-                        append_len = (
-                            len(str(talk_list))
-                            + len(q)
-                            + len(talk_prefix)
-                            + len(question)
-                        )
-                        if append_len > max_size:
-                            log_dbg(
-                                "replay over limit. skip history. len: "
-                                + str(append_len)
-                            )
-                            break
-
-                        log_dbg("replay over limit, append pre question.")
-                        talk_history.insert(
-                            talk_list_append, {"role": "user", "content": q}
-                        )
-                        continue
-                    # 0 是设定 先放回答再放提问，这样顺序反过来
-                    talk_history.insert(
-                        talk_list_append, {"role": "assistant", "content": a}
-                    )
-                    talk_history.insert(
-                        talk_list_append, {"role": "user", "content": q}
-                    )
-            return talk_history
-
-        # 倒着插入的，所以要把历史放在前面插入
-        if self.model_enable:
+    def __get_token_len(self, slot: int, item: dict, model: str) -> Tuple[int, int]:
+        encoding = encoding_name(model)
+        if encoding != self.__token_encoding:
+            self.__token_encoding = encoding
+            self.__token_len = [None] * self.size
+
+        if 0 <= slot < self.size and self.__token_len[slot]:
+            return self.__token_len[slot]
+
+        token_len = (count_tokens(item["q"], model), count_tokens(item["a"], model))
+        if 0 <= slot < self.size:
+            self.__token_len[slot] = token_len
+        return token_len
+
+    def __pack_talk(
+        self, talk_items, max_size: int, used: int, model: str
+    ) -> Tuple[List[Dict], int]:
+        # talk_items 从新到旧, 先倒着放, 最后反转一次.
+        packed: List[Dict] = []
+        for slot, item in talk_items:
+            q = item.get("q", None)
+            a = item.get("a", None)
+            if not q or not a:
+                continue
+
+            q_len, a_len = self.__get_token_len(slot, item, model)
+            append_len = used + q_len + a_len + 2 * MESSAGE_TOKEN_OVERHEAD
+            if append_len <= max_size:
+                packed.append({"role": "assistant", "content": a})
+                packed.append({"role": "user", "content": q})
+                used = append_len
+                continue
+
+            log_dbg(f"replay over limit. now tokens: {append_len}")
+            append_len = used + q_len + MESSAGE_TOKEN_OVERHEAD
+            if append_len > max_size:
+                log_dbg(f"replay over limit. skip history. tokens: {append_len}")
+                break
+
+            log_dbg("replay over limit, append pre question.")
+            packed.append({"role": "user", "content": q})
+            used = append_len
+
+        packed.reverse()
+        return packed, used
+
+    def __get_lexical_index(self) -> BM25Index:
+        if self.__lexical_index:
+            return self.__lexical_index
+
+        with self.__append_lock:
+            if self.__lexical_index:
+                return self.__lexical_index
+
+            # 第一次用到时才建索引, 不拖慢启动.
+            index = BM25Index(self.size)
+            for slot, item in self.pool.newest():
+                index.add(slot, item.q + "\n" + item.a)
+            self.__lexical_index = index
+            return index
+
+    def __age(self, slot: int) -> float:
+        # 这条记忆之后又写入了多少条. 刷新过的重复记忆从刷新时算起, 比刷新前写入的那条新半步.
+        touched = self.__touched.get(slot, None)
+        if touched is not None:
+            return self.__writes - touched - 0.5
+        return (self.pool.head - 1 - slot) % self.size
+
+    def __newest(self) -> Generator[Tuple[int, TalkItem], None, None]:
+        # 和 pool.newest() 一样从新到旧, 刷新过的重复记忆按 age 插到对应的位置
+        touched = sorted((self.__age(slot), slot) for slot in list(self.__touched))
+        touched_slots = {slot for _, slot in touched}
+        pos = 0
+        for slot, item in self.pool.newest():
+            if slot in touched_slots:
+                continue
+            age = self.__age(slot)
+            while pos < len(touched) and touched[pos][0] <= age:
+                yield touched[pos][1], self.pool[touched[pos][1]]
+                pos += 1
+            yield slot, item
+        for _, slot in touched[pos:]:
+            yield slot, self.pool[slot]
+
+    def __rank_talk(self, question: str) -> List[Tuple[int, TalkItem]]:
+        """
+        把 BM25 字面匹配, 模型召回和最近的对话放在一起排序:
+        score = 相关度(0~1) + recent_weight * 0.5 ^ (age / half_life)
+        age 是这条记忆之后又写入了多少条.
+        """
+        relevance: Dict[int, float] = {}
+
+        lexical = self.__get_lexical_index().search(question, self.rank_lexical_limit)
+        if lexical:
+            top = lexical[0][1]
+            for slot, score in lexical:
+                relevance[slot] = score / top
+
+        if self.model_ready():
+            for item in self.__predict_model(question):
+                slot = item.get("slot", -1)
+                if 0 <= slot < self.size and self.pool[slot]:
+                    relevance[slot] = max(relevance.get(slot, 0.0), float(item["prob"]))
+
+        # 最近的几轮对话不管相关度都作为候选, 保证上下文连贯.
+        for cnt, (slot, _) in enumerate(self.__newest()):
+            if cnt >= self.rank_recent_limit:
+                break
+            relevance.setdefault(slot, 0.0)
+
+        ranked = []
+        for slot, score in relevance.items():
+            age = self.__age(slot)
+            score += self.rank_recent_weight * 0.5 ** (age / self.rank_half_life)
+            ranked.append((score, age, slot))
+        ranked.sort(key=lambda x: (-x[0], x[1]))
+        log_dbg(f"rank memory: {[(slot, round(score, 3)) for score, _, slot in ranked[:8]]}")
+
+        return [(slot, self.pool[slot]) for _, _, slot in ranked if self.pool[slot]]
+
+    def __pack_ranked(
+        self, question: str, max_size: int, used: int, model: str
+    ) -> Tuple[List[Dict], int]:
+        # 按排名从高到低放, 放不下的跳过, 最后按时间先后输出.
+        picked = []
+        for slot, item in self.__rank_talk(question):
+            q_len, a_len = self.__get_token_len(slot, item, model)
+            append_len = used + q_len + a_len + 2 * MESSAGE_TOKEN_OVERHEAD
+            if append_len > max_size:
+                continue
+            picked.append((self.__age(slot), item))
+            used = append_len
+
+        picked.sort(key=lambda x: -x[0])
+        history: List[Dict] = []
+        for _, item in picked:
+            history.append({"role": "user", "content": item.q})
+            history.append({"role": "assistant", "content": item.a})
+        return history, used
+
+    def search(self, question: str, max_size: int = 1024, model: str = "") -> List[Dict]:
+        # max_size 是 token 数量
+        used = count_tokens(question, model) + MESSAGE_TOKEN_OVERHEAD
+
+        if self.rank == "hybrid":
+            history, used = self.__pack_ranked(question, max_size, used, model)
+            log_dbg(f"memory tokens: {used}")
+            return history
+
+        # 召回的记忆放在最前面, 最多占一半.
+        recall_history: List[Dict] = []
+        if self.model_ready():
             recall_items = self.__predict_model(question)
             log_dbg("model search: " + str(recall_items))
-            talk_history = qa_dict_to_list(
-                recall_items, talk_history, talk_history_append, max_size / 2
+            recall_history, used = self.__pack_talk(
+                [(item.get("slot", -1), item) for item in recall_items],
+                max_size / 2,
+                used,
+                model,
             )
 
-        # 将model 的数据放在最前面。
-        talk_history_append = len(talk_history)
-        talk_items = self.__get_memory(question)
-        talk_history = qa_dict_to_list(
-            reversed(talk_items), talk_history, talk_history_append
-        )
+        talk_history, used = self.__pack_talk(self.__newest(), max_size, used, model)
+        log_dbg(f"memory tokens: {used}")
 
-        return talk_history
+        return recall_history + talk_history
 
     def __model_enable(self) -> bool:
         return len(self.memory_model_type)
@@ -227,10 +621,23 @@ class Memory:
             return self.memory_model.predict(question, predict_limit=3)
         return []
 
+    def __append_model(self, slot: int, talk_item: dict):
+        try:
+            with self.__model_lock:
+                if self.__model_state == "loading":
+                    self.__pending_slots.append(slot)
+                    return
+                if self.model_enable:
+                    self.memory_model.append(slot, talk_item)
+                if self.train_scheduler:
+                    self.train_scheduler.notify(slot)
+        except Exception as e:
+            log_err(f"fail to append model: {e}")
+
     def __load_model(self):
         try:
             if self.model_enable:
-                ret = self.memory_model.load_model(self.memory_model_file)
+                ret = self.memory_model.load_model(self.memory_model_file, self.pool)
                 if not ret:
                     log_err("fail to laod memory: " + str(self.memory_model_file))
                     return False
@@ -261,6 +668,22 @@ class Memory:
 
         return True
 
+    def __get_dedup_index(self):
+        if self.__dedup_index:
+            return self.__dedup_index
+
+        # 第一次 append 时才建索引, 不拖慢启动.
+        index = SimHashIndex(self.size, self.dedup_distance)
+        for slot, item in enumerate(self.pool):
+            if item:
+                index.add(slot, simhash(item.q + "\n" + item.a))
+        self.__dedup_index = index
+        return index
+
+    def __find_duplicate(self, q: str, a: str) -> Tuple[int, int]:
+        sig = simhash(q + "\n" + a)
+        return self.__get_dedup_index().find(sig), sig
+
     def append(self, q: str, a: str):
         if not self.need_memory(a):
             log_info("no need save memory.")
@@ -268,11 +691,31 @@ class Memory:
 
         self.memory_has_change = True
 
-        next_idx = self.__get_next_idx()
-        talk_item = {"q": q, "a": a, "idx": next_idx}
-        log_dbg("append memory: " + str(talk_item))
-        self.pool[self.idx] = talk_item
-        self.idx = self.__get_next_idx()
+        with self.__append_lock:
+            sig = -1
+            if self.dedup:
+                dup_slot, sig = self.__find_duplicate(q, a)
+                if dup_slot >= 0:
+                    # 重复的问答不占新槽位, 原地刷新成最新, 最近窗口和时间衰减都按这一次算.
+                    log_dbg(f"touch duplicate memory: slot {dup_slot}: {self.pool[dup_slot]}")
+                    self.__touched[dup_slot] = self.__writes
+                    self.__journal_write({"touch": dup_slot})
+                    return
+
+            slot = self.pool.head
+            talk_item = TalkItem(q, a, self.pool.next_slot(slot))
+            log_dbg("append memory: " + str(talk_item))
+            if sig >= 0:
+                self.__dedup_index.add(slot, sig)
+            if self.__lexical_index:
+                self.__lexical_index.add(slot, q + "\n" + a)
+            self.__text_bytes += self.__item_bytes(talk_item) - self.__item_bytes(self.pool[slot])
+            self.pool.append(talk_item)
+            self.__touched.pop(slot, None)
+            self.__writes += 1
+            self.__token_len[slot] = None
+            self.__journal_write({"slot": slot, **talk_item.to_dict()})
+            self.__append_model(slot, talk_item)
 
     def need_memory(self, a: str) -> bool:
         if ("OpenAI" in a) or ("ChatGPT" in a):
@@ -286,7 +729,159 @@ class Memory:
                 return False
         return True
 
-    def __get_next_idx(self) -> int:
-        if self.idx >= (self.size - 1):
-            return 0
-        return self.idx + 1
+
+class MemorySpace:
+    """
+    按会话(session_id)或 QQ 用户/群划分记忆分区.
+    最近使用的分区常驻内存, 超出数量或内存预算时淘汰最久未使用的分区, 冷分区用到时再从磁盘加载.
+    正在回答的分区通过 acquire/release 钉住, 不会在回答过程中被淘汰.
+    """
+
+    enable: bool = False
+    max_resident: int = 64
+    max_resident_bytes: int = 256 * 1024 * 1024
+    default: Memory
+
+    def __init__(self):
+        self.__partitions: "OrderedDict[str, Memory]" = OrderedDict()
+        self.__pins: Dict[str, int] = {}
+        self.__loading: Dict[str, threading.Event] = {}
+        self.__lock = threading.Lock()
+
+        setting = Config.load_setting("aimi")
+        try:
+            self.enable = bool(setting["memory_partition"])
+        except:
+            self.enable = False
+        try:
+            self.max_resident = int(setting["memory_partition_resident"])
+        except:
+            self.max_resident = 64
+        try:
+            self.max_resident_bytes = int(setting["memory_partition_budget_mb"]) * 1024 * 1024
+        except:
+            self.max_resident_bytes = 256 * 1024 * 1024
+
+        self.default = Memory()
+
+    @property
+    def openai_conversation_id(self) -> str:
+        return self.default.openai_conversation_id
+
+    @openai_conversation_id.setter
+    def openai_conversation_id(self, conversation_id: str):
+        self.default.openai_conversation_id = conversation_id
+
+    @property
+    def model_state(self) -> str:
+        return self.default.model_state
+
+    @staticmethod
+    def partition_name(key: str) -> str:
+        # 目录名只保留安全字符, 再带上原始 key 的哈希, 不同的 key 不会落到同一个目录.
+        key = str(key)
+        safe = re.sub(r"[^\w\-]", "_", key)[:64]
+        return f"{safe}_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]}"
+
+    def acquire(self, key: str = "") -> Memory:
+        """
+        取出分区并钉住, 用完必须调用 release. 钉住的分区不会被淘汰.
+        冷分区在全局锁外面加载, 同一个分区同时只有一个线程加载, 其他线程等它加载完.
+        """
+        if not self.enable or not key:
+            return self.default
+
+        partition = self.partition_name(key)
+        while True:
+            with self.__lock:
+                memory = self.__partitions.get(partition, None)
+                if memory:
+                    self.__partitions.move_to_end(partition)
+                    self.__pins[partition] = self.__pins.get(partition, 0) + 1
+                    return memory
+
+                loading = self.__loading.get(partition, None)
+                if not loading:
+                    loading = threading.Event()
+                    self.__loading[partition] = loading
+                    break
+            # 正在加载或者正在淘汰, 等完成后重新取.
+            loading.wait()
+
+        try:
+            memory = Memory(partition)
+        except Exception:
+            with self.__lock:
+                del self.__loading[partition]
+            loading.set()
+            raise
+        log_dbg(f"load memory partition: {partition}")
+
+        with self.__lock:
+            self.__partitions[partition] = memory
+            self.__pins[partition] = self.__pins.get(partition, 0) + 1
+            del self.__loading[partition]
+            released = self.__pick_release()
+        loading.set()
+
+        self.__release_partition(released)
+        return memory
+
+    def release(self, memory: Memory):
+        if memory is self.default or not memory.partition:
+            return
+
+        with self.__lock:
+            pins = self.__pins.get(memory.partition, 0) - 1
+            if pins > 0:
+                self.__pins[memory.partition] = pins
+            else:
+                self.__pins.pop(memory.partition, None)
+            released = self.__pick_release()
+
+        self.__release_partition(released)
+
+    def __pick_release(self) -> List[Tuple[str, Memory, threading.Event]]:
+        # 在锁里挑出要淘汰的分区, 跳过钉住的. 保存和关闭放到锁外面做.
+        released = []
+        used = sum(m.resident_bytes() for m in self.__partitions.values())
+        for partition in list(self.__partitions.keys()):
+            if len(self.__partitions) <= 1:
+                break
+            if len(self.__partitions) <= self.max_resident and used <= self.max_resident_bytes:
+                break
+            if self.__pins.get(partition, 0):
+                continue
+
+            memory = self.__partitions.pop(partition)
+            used -= memory.resident_bytes()
+            # 关闭完成之前重新加载这个分区要等着, 不然会读到写了一半的快照.
+            closing = threading.Event()
+            self.__loading[partition] = closing
+            released.append((partition, memory, closing))
+        return released
+
+    def __release_partition(self, released: List[Tuple[str, Memory, threading.Event]]):
+        for partition, memory, closing in released:
+            try:
+                if not memory.save_memory(sync=True):
+                    log_err(f"fail to save memory partition: {partition}")
+                memory.close()
+                log_dbg(f"release memory partition: {partition}")
+            finally:
+                with self.__lock:
+                    del self.__loading[partition]
+                closing.set()
+
+    def dream(self):
+        return self.default.dream()
+
+    def save_memory(self, sync: bool = False) -> bool:
+        ret = self.default.save_memory(sync)
+        with self.__lock:
+            partitions = list(self.__partitions.items())
+        for partition, memory in partitions:
+            if not memory.save_memory(sync):
+                log_err(f"fail to save memory partition: {partition}")
+                ret = False
+        return ret
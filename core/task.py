@@ -4,12 +4,14 @@ import os
 import re
 import time
 import copy
-from typing import Dict, Any, List, Generator, Optional, Union, Set
-from pydantic import BaseModel, constr
+from collections import deque
+from typing import Dict, Any, Deque, List, Generator, Optional, Union, Set, Tuple
+from pydantic import BaseModel, PrivateAttr, constr
 
 from tool.config import Config
 from tool.util import (
     log_dbg,
+    log_dbg_enable,
     log_err,
     log_info,
     make_context_messages,
@@ -20,12 +22,15 @@ from tool.util import (
     is_json,
 )
 
-from tool.json_stream import JsonStream, JsonStreamData, JsonStreamRoot
+from tool.json_stream import JsonStream, JsonStreamData, JsonStreamDataType, JsonStreamRoot
+from tool.json_template import JsonTemplate
+from tool.token_count import count_tokens, encoding_name, MESSAGE_TOKEN_OVERHEAD
 
 from core.aimi_plugin import (
     ChatBot,
     ChatBotType,
     ActionToolItem,
+    ActionCall,
     ExternAction,
     BotAskData,
     Bot,
@@ -58,6 +63,128 @@ class TaskRunningItem(BaseModel):
     conclusion: Optional[Union[str, None]] = None
     execute: constr(regex="system|AI")
 
+    # 序列化结果缓存在记录自己身上, 字段被重新赋值时失效.
+    # request 里的字典被原地修改的话检测不到, 改完要自己调 touch().
+    _json: Optional[str] = PrivateAttr(default=None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name not in self.__private_attributes__:
+            self.touch()
+
+    def touch(self):
+        object.__setattr__(self, "_json", None)
+
+    def to_json(self) -> str:
+        if self._json is None:
+            object.__setattr__(self, "_json", json.dumps(self.dict(), ensure_ascii=False))
+        return self._json
+
+
+def running_to_json(running: List[TaskRunningItem]) -> str:
+    # 和 json.dumps([it.dict() for it in running], ensure_ascii=False) 结果一样, 只拼字符串
+    return "[" + ", ".join(run.to_json() for run in running) + "]"
+
+
+class TaskRunning:
+    """
+    action_running 历史. 每条记录写入时缓存序列化大小和 token 数,
+    分别维护 chat_from 和其他动作的数量, 淘汰时直接取对应类别里最旧的一条, O(1).
+    记录写入之后不要再原地修改, 否则缓存的大小会不准.
+    token 数按 model 的分词方式计算, 和请求时的预算用同一个 tokenizer.
+    """
+
+    def __init__(self, running: List[TaskRunningItem] = None, model: str = ""):
+        self.__items: Dict[int, TaskRunningItem] = {}
+        self.__sizes: Dict[int, Tuple[int, int]] = {}
+        self.__chat_from: Deque[int] = deque()
+        self.__other: Deque[int] = deque()
+        self.__seq = 0
+        self.__repr_size = 0
+        self.tokens = 0
+        self.model = model
+        self.encoding = encoding_name(model)
+        if running:
+            self.extend(running)
+
+    def set_model(self, model: str):
+        self.model = model
+        encoding = encoding_name(model)
+        if encoding == self.encoding:
+            return
+        # 分词方式变了才需要全部重新计数
+        self.encoding = encoding
+        self.tokens = 0
+        for seq, run in self.__items.items():
+            size, _ = self.__sizes[seq]
+            tokens = count_tokens(run.to_json(), model)
+            self.__sizes[seq] = (size, tokens)
+            self.tokens += tokens
+
+    @staticmethod
+    def is_chat_from(run: TaskRunningItem) -> bool:
+        return ActionObject.chat_response_prefix in run.call
+
+    def append(self, run: TaskRunningItem):
+        seq = self.__seq
+        self.__seq += 1
+
+        size = len(repr(run))
+        tokens = count_tokens(run.to_json(), self.model)
+        self.__items[seq] = run
+        self.__sizes[seq] = (size, tokens)
+        self.__repr_size += size
+        self.tokens += tokens
+        if self.is_chat_from(run):
+            self.__chat_from.append(seq)
+        else:
+            self.__other.append(seq)
+
+    def extend(self, running: List[TaskRunningItem]):
+        for run in running:
+            self.append(run)
+
+    def with_tokens(self) -> Generator[Tuple[TaskRunningItem, int], None, None]:
+        for seq, run in self.__items.items():
+            yield run, self.__sizes[seq][1]
+
+    def pop_oldest(self, chat_from: bool) -> TaskRunningItem:
+        seq = (self.__chat_from if chat_from else self.__other).popleft()
+        size, tokens = self.__sizes.pop(seq)
+        self.__repr_size -= size
+        self.tokens -= tokens
+        return self.__items.pop(seq)
+
+    @property
+    def size(self) -> int:
+        # 等于 len(str(list(running)))
+        cnt = len(self.__items)
+        return 2 + self.__repr_size + 2 * (cnt - 1) if cnt else 2
+
+    @property
+    def chat_from_count(self) -> int:
+        return len(self.__chat_from)
+
+    @property
+    def other_count(self) -> int:
+        return len(self.__other)
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    def __iter__(self):
+        return iter(self.__items.values())
+
+    def __getitem__(self, idx):
+        if idx == -1 and self.__items:
+            return next(reversed(self.__items.values()))
+        if idx == 0 and self.__items:
+            return next(iter(self.__items.values()))
+        return list(self.__items.values())[idx]
+
+    def __str__(self) -> str:
+        return str(list(self.__items.values()))
+
 
 class TaskActionKey:
     Type = "type"
@@ -142,6 +269,20 @@ class TaskRunningItemStreamType:
 
 
 class TaskStreamContext:
+    # 流式处理只关心动作本身的字段, 其他内容交给解析器直接跳过
+    subscribe: List[str] = [
+        f'{JsonStreamRoot.Root}[*]["{key}"]'
+        for key in [
+            TaskActionKey.Type,
+            TaskActionKey.Timestamp,
+            TaskActionKey.Expect,
+            TaskActionKey.Reasoning,
+            TaskActionKey.Call,
+            TaskActionKey.Request,
+            TaskActionKey.Conclusion,
+            TaskActionKey.Execute,
+        ]
+    ]
     jss: JsonStream
     check: Dict = {}
     stream_tasks: List[TaskRunningItem] = []
@@ -151,8 +292,8 @@ class TaskStreamContext:
     __now_task_idx = 0
 
     def need_wait(self) -> bool:
-        # 如果解析异常出现了错误, 那就不要处理了
-        if len(self.error):
+        # 如果解析异常出现了错误, 那就不要处理了. 流式解析器比较严格, 不合法的回复交给 task_dispatch 宽松解析.
+        if len(self.error) or len(self.jss.error):
             return False
         # 没有解析到任何动作的时候进行等待
         if not len(self.stream_tasks[0].call):
@@ -169,7 +310,7 @@ class TaskStreamContext:
     def clear_cache(self):
         self.__now_task_idx = 0
         self.check = {}
-        self.jss = JsonStream()
+        self.jss = JsonStream(self.subscribe)
         task = TaskRunningItem(timestamp=0, call="", request=None, execute="AI")
         self.stream_tasks = [task]
 
@@ -259,10 +400,14 @@ class TaskStreamContext:
                     if action_key and hasattr(
                         self.stream_tasks[self.__now_task_idx], action_key
                     ):
+                        # 容器的 data 是解析器里共享的对象, 复制一份再存
+                        data = stream.data
+                        if isinstance(data, (dict, list)):
+                            data = copy.deepcopy(data)
                         setattr(
                             self.stream_tasks[self.__now_task_idx],
                             action_key,
-                            stream.data,
+                            data,
                         )
 
                 yield stream
@@ -295,6 +440,11 @@ class Task(Bot):
     tasks: Dict[int, TaskItem] = {}
     action_tools: List[ActionToolItem] = []
     extern_action: ExternAction
+    # call -> action, 内置动作和外部动作合在一起, 只在动作增删时重建
+    __action_registry: Optional[Dict[str, ActionToolItem]] = None
+    __builtin_calls: Set[str] = set()
+    # call -> 外部动作的实现, 包含所有没被内置动作覆盖的外部动作 (动作表里只列出 brief 的一部分)
+    __extern_calls: Dict[str, ActionCall] = {}
     notes: List[str] = []
     keep_note_len: int = 0
     execute_system_calls: List[str] = []
@@ -302,7 +452,7 @@ class Task(Bot):
     now_task_id: str = 1
     aimi_name: str = "Aimi"
     master_name: str = "Master"
-    running: List[TaskRunningItem] = []
+    running: TaskRunning
     max_running_size: int = 5 * 1000
     max_notes_size: int = 6
     database_path: str = f"{Config.database_path}/default"
@@ -313,10 +463,13 @@ class Task(Bot):
     run_model = Sandbox.RunModel.system
     run_timeout: int = 15
     use_talk_messages: bool = True
-    models: Dict[str, Dict[str, str]] = {}
+    models: Dict[str, Dict[str, Union[str, int]]] = {}
     now_ctx_size: int = 0
+    running_messages_tokens: int = 0
+    link_think_tokens: int = 0
     enable_chat_to_python: bool = False
     timeout: int = 30
+    prompt_cache: bool = False
 
     def update_runnning_from_task_stream(self, task_stream, task_response=None):
         try:
@@ -537,7 +690,11 @@ class Task(Bot):
 
         return running
 
-    def task_dispatch(self, res: str) -> Generator[str, None, None]:
+    def task_dispatch(self, res: str, data: Any = None) -> Generator[str, None, None]:
+        """
+        data: 流式解析器已经解析好的结果, 有的话直接用, 不再解析 res.
+        """
+
         def get_json_content(answer: str):
             has_error = False
             # del ```python
@@ -576,6 +733,25 @@ class Task(Bot):
 
             return answer, has_error
 
+        def load_json_content(answer: str):
+            # 大部分回复本身就是标准的 List[action], 先用 json.loads, 不行再截取内容用 json5 兜底.
+            try:
+                data = json.loads(answer)
+                if isinstance(data, list):
+                    return data, False
+            except Exception:
+                pass
+
+            answer, has_error = get_json_content(answer)
+            try:
+                return json.loads(answer), has_error
+            except Exception:
+                pass
+            try:
+                return json5.loads(answer), has_error
+            except Exception as e:
+                raise Exception(f"fail to load data: {str(e)}")
+
         def repair_action_dict(data):
             has_error = False
             if "action" in data and "{" in data and len(data) == 1:
@@ -583,8 +759,7 @@ class Task(Bot):
                 has_error = True
                 return data["action"], has_error
 
-            all_action_tools = self.action_tools
-            all_action_tools.extend(self.extern_action.brief())
+            all_action = self.get_all_action()
 
             for action in data:
                 # set action -> call
@@ -623,37 +798,38 @@ class Task(Bot):
                         f"fail to fill chat_from execute -> system: {str(e)}"
                     )
 
-                for tool in all_action_tools:
-                    try:
-                        if action["call"] != tool.call:
-                            continue
-                        # fix no execute.
-                        if "execute" in action and action["execute"] != tool.execute:
-                            log_err(f"AI try overwrite execute: {tool.call}")
-                            action["execute"] = tool.execute
-                            has_error = True
-                        if "execute" not in action:
-                            log_dbg(
-                                f"fill call({tool.call}) miss execute: {tool.execute}"
-                            )
-                            action["execute"] = tool.execute
+                tool = all_action.get(action.get("call"))
+                if not tool:
+                    continue
 
-                    except Exception as e:
-                        raise Exception(f"fail to fix excute of {tool.call}: {str(e)}")
+                try:
+                    # fix no execute.
+                    if "execute" in action and action["execute"] != tool.execute:
+                        log_err(f"AI try overwrite execute: {tool.call}")
+                        action["execute"] = tool.execute
+                        has_error = True
+                    if "execute" not in action:
+                        log_dbg(
+                            f"fill call({tool.call}) miss execute: {tool.execute}"
+                        )
+                        action["execute"] = tool.execute
 
-                    try:
-                        if (
-                            "dream" != action["call"]
-                            and "request" in action
-                            and isinstance(action["request"], dict)
-                            and "type" not in action["request"]
-                        ):
-                            log_err(f"AI no set object type: {tool.call}")
-                            action["request"]["type"] = "object"
-                            has_error = True
+                except Exception as e:
+                    raise Exception(f"fail to fix excute of {tool.call}: {str(e)}")
 
-                    except Exception as e:
-                        raise Exception(f"fail to fill action object type: {str(e)}")
+                try:
+                    if (
+                        "dream" != action["call"]
+                        and "request" in action
+                        and isinstance(action["request"], dict)
+                        and "type" not in action["request"]
+                    ):
+                        log_err(f"AI no set object type: {tool.call}")
+                        action["request"]["type"] = "object"
+                        has_error = True
+
+                except Exception as e:
+                    raise Exception(f"fail to fill action object type: {str(e)}")
 
             return data, has_error
 
@@ -666,18 +842,8 @@ class Task(Bot):
         has_format_error = False
         running: List[TaskRunningItem] = []
         try:
-            answer, has_format_error = get_json_content(res)
-
-            # 忽略错误.
-            # decoder = json.JSONDecoder(strict=False)
-            # data = decoder.decode(answer)
-            data = {}
-            try:
-                # del zh ,  ..
-                answer = answer.replace(", ", ", ")
-                data = json5.loads(answer)
-            except Exception as e:
-                raise Exception(f"fail to load data: {str(e)}")
+            if data is None:
+                data, has_format_error = load_json_content(res)
 
             try:
                 data, has_format_error = repair_action_dict(data)
@@ -948,9 +1114,9 @@ class Task(Bot):
                             if save_action_code:
                                 yield f"**Ability method:** \n```python\n{save_action_code}\n```\n"
 
-                    elif task.call in self.extern_action.actions:
+                    elif task.call in self.get_extern_calls():
                         try:
-                            action_call = self.extern_action.actions[task.call]
+                            action_call = self.get_extern_calls()[task.call]
                             chat_from = action_call.chat_from
                             action_description = action_call.action.description
 
@@ -1128,8 +1294,8 @@ class Task(Bot):
                 f"save_action:\n{json.dumps(action.dict(), indent=4, ensure_ascii=False)}"
             )
 
-            default_calls = [action.call for action in self.action_tools]
-            if action.call in default_calls:
+            self.get_all_action()
+            if action.call in self.__builtin_calls:
                 log_err(f"aleary exsit {action.call}")
                 return (
                     False,
@@ -1199,6 +1365,7 @@ s_action = ActionToolItem(
             )
             if not done:
                 return False, f"extetn save failed : {str(err)}, please fix."
+            self.__action_registry = None
 
             response = f"save {save_action_call} done."
             log_info(f"chat_to_save_action: {response}")
@@ -1228,6 +1395,7 @@ s_action = ActionToolItem(
                             for action in self.action_tools
                             if action.call != "chat_to_bing"
                         ]
+                        self.__action_registry = None
                         log_err(
                             f"fail to ask bing, del action chat_to_bing. {str(res)}"
                         )
@@ -1718,6 +1886,10 @@ s_action = ActionToolItem(
         return False
 
     def __init__(self, chatbot: ChatBot, setting={}):
+        self.__guidance_cache = None
+        self.__guidance_tokens: Dict[str, int] = {}
+        # 没有 task.yml 的时候 __load_task_data 不会设置 running
+        self.running = TaskRunning()
         try:
             self.__load_setting(setting)
             self.__load_task_data()
@@ -1743,6 +1915,9 @@ s_action = ActionToolItem(
                     self.models[k]['model'] = v['model']
                 if 'type' in v:
                     self.models[k]['type'] = v['type']
+                # 上下文窗口和给回复预留的 token 数, 没配置就不限制.
+                self.models[k]['max_tokens'] = int(v['max_tokens']) if 'max_tokens' in v else 0
+                self.models[k]['reply_tokens'] = int(v['reply_tokens']) if 'reply_tokens' in v else 1024
                 
 
 
@@ -1790,6 +1965,11 @@ s_action = ActionToolItem(
             log_err(f"fail to load task: {e}")
             self.timeout = 30
 
+        try:
+            self.prompt_cache = bool(setting["prompt_cache"])
+        except Exception as e:
+            self.prompt_cache = False
+
     def __load_task_data(self):
         has_err = False
         task_config = {}
@@ -1832,9 +2012,11 @@ s_action = ActionToolItem(
             has_err = True
 
         try:
-            self.running = [TaskRunningItem(**run) for run in task_config["running"]]
+            self.running = TaskRunning(
+                [TaskRunningItem(**run) for run in task_config["running"]]
+            )
         except Exception as e:
-            self.running = []
+            self.running = TaskRunning()
             log_err(f"fail to load task config: {str(e)}")
             has_err = True
 
@@ -2248,6 +2430,7 @@ def chat_from(request: dict = None):
                     execute="system",
                 )
             )
+        self.__action_registry = None
 
         if not self.now_task_id or not int(self.now_task_id):
             self.now_task_id = 1
@@ -2313,45 +2496,30 @@ def chat_from(request: dict = None):
                 )
                 self.keep_note_len += 1
 
-            self.running = running
+            self.running = TaskRunning(running)
             log_dbg(f"no have running")
 
     def __running_release_action(self):
         while True:
-            run_size = len(str(self.running))
+            run_size = self.running.size
             if run_size < self.max_running_size or len(self.running) <= 2:
                 break
             log_dbg(f"now try fix size.. run({run_size}) > max_size({self.max_running_size})")
 
             # AI 只基于信息运行， 尽可能保留(USER)矫正信息, 提升自循环运行和系统自我矫正能力.
-            chat_to_hook = 0
-            chat_from_hook = 0
-
             # 平衡 chat_from 和 其他类型
-            for run in self.running:
-                if ActionObject.chat_response_prefix in run.call:
-                    chat_from_hook += 1
-                else:
-                    chat_to_hook += 1
-                    log_dbg(f'{run.call} not chat from, {repr("chat_form_")} not in {repr(run.call)}')
-            
-            need_pop_idx = 0
-            for i, run in enumerate(self.running):
-                # 释放 多出来的部分, 优先释放 AI 消息, 这样可以避免 AI 大概率生成 chat_from
-                is_chat_from = True if ActionObject.chat_response_prefix in run.call else False
-                
-                if not is_chat_from and chat_from_hook <= chat_to_hook:
-                    need_pop_idx = i
-                    log_dbg(f"from({chat_from_hook}) <= chat_to({chat_to_hook})")
-                    break
-                elif is_chat_from and chat_from_hook > chat_to_hook:
-                    need_pop_idx = i
-                    log_dbg(f"from({chat_from_hook}) > chat_to({chat_to_hook})")
-                    break
-            
-            log_dbg(f"release {need_pop_idx}: {self.running[need_pop_idx].call}")
-            del self.running[need_pop_idx]
+            chat_from_hook = self.running.chat_from_count
+            chat_to_hook = self.running.other_count
+
+            # 释放 多出来的部分, 优先释放 AI 消息, 这样可以避免 AI 大概率生成 chat_from
+            if chat_from_hook <= chat_to_hook:
+                log_dbg(f"from({chat_from_hook}) <= chat_to({chat_to_hook})")
+                run = self.running.pop_oldest(chat_from=False)
+            else:
+                log_dbg(f"from({chat_from_hook}) > chat_to({chat_to_hook})")
+                run = self.running.pop_oldest(chat_from=True)
 
+            log_dbg(f"release: {run.call}")
 
     def __append_running(self, running: List[TaskRunningItem]):
         if not (self.now_task_id in self.tasks):
@@ -2362,11 +2530,7 @@ def chat_from(request: dict = None):
             log_dbg(f"running is empty... ")
             return
         
-        self.running.extend(running)
-
         try:
-            self.__running_release_action()
-
             # set type in front
             for run in running:
                 if isinstance(run.request, dict):
@@ -2378,15 +2542,20 @@ def chat_from(request: dict = None):
                             run.request["response"], "type"
                         )
 
+            # 写入时会缓存大小, 所以要先整理好再写入.
+            self.running.extend(running)
+
+            self.__running_release_action()
+
         except Exception as e:
             log_dbg(f"fail to append running {e}")
             raise Exception(f"fail to appnd run : {e}")
 
     def get_running(self) -> str:
-        run_dict = [item.dict() for item in self.running]
-        js = json.dumps(run_dict, ensure_ascii=False)
-        log_dbg(f"running: {json.dumps(run_dict, indent=4, ensure_ascii=False)}")
-        return str(js)
+        js = running_to_json(self.running)
+        if log_dbg_enable():
+            log_dbg(f"running: {js}")
+        return js
 
     def is_call(self, caller: Bot, ask_data: BotAskData) -> bool:
         calls = ["#task", "#aimi-task", "#at"]
@@ -2421,68 +2590,143 @@ def chat_from(request: dict = None):
 
         return models
     
-    def action_running_to_messages(self) -> List[Dict]:
+    def __trim_running(self, max_tokens: int) -> Tuple[List[TaskRunningItem], int]:
+        # 从最新往前放, 放不下就停, 至少保留最新的一条. 每条之间的 ", " 算一个 token.
+        picked = []
+        used = 0
+        for run, tokens in reversed(list(self.running.with_tokens())):
+            if picked and used + tokens + 1 > max_tokens:
+                break
+            picked.append(run)
+            used += tokens + 1
+        picked.reverse()
+        if len(picked) < len(self.running):
+            log_dbg(f"trim running: {len(self.running)} -> {len(picked)}, tokens: {used}")
+        return picked, used
+
+    def action_running_to_messages(self, max_tokens: int = 0) -> List[Dict]:
+        """
+        max_tokens > 0 时按 token 预算从最旧的消息开始丢弃, 至少保留最新的一条消息.
+        """
         messages = []
+        messages_tokens = []
         ai_messages: List[TaskRunningItem] = []
-        for run in self.running:
+        ai_tokens = 0
+        for run, tokens in self.running.with_tokens():
             if ActionObject.chat_response_prefix in run.call:
                 messages.append(
                     {
                         "role": "user",
-                        "content": f"[{json.dumps(run.dict(), ensure_ascii=False)}]",
+                        "content": f"[{run.to_json()}]",
                     }
                 )
+                messages_tokens.append(tokens + MESSAGE_TOKEN_OVERHEAD)
             else:
-                if run.execute != "system":
-                    ai_messages.append(run)
-                else:
-                    ai_messages.append(run)
+                ai_messages.append(run)
+                ai_tokens += tokens
+                if run.execute == "system":
                     messages.append(
                         {
                             "role": "assistant",
-                            "content": f"{json.dumps([it.dict() for it in ai_messages], ensure_ascii=False)}",
+                            "content": running_to_json(ai_messages),
                         }
                     )
+                    messages_tokens.append(ai_tokens + MESSAGE_TOKEN_OVERHEAD)
                     ai_messages = []
+                    ai_tokens = 0
         if len(ai_messages):
             messages.append(
                 {
                     "role": "assistant",
-                    "content": f"{json.dumps([it.dict() for it in ai_messages], ensure_ascii=False)}",
+                    "content": running_to_json(ai_messages),
                 }
             )
+            messages_tokens.append(ai_tokens + MESSAGE_TOKEN_OVERHEAD)
             ai_messages = []
 
-        for msg in messages:
-            role = msg["role"]
-            content = msg["content"]
-            js = json.loads(content)
-            log_dbg(f"{role}:\n{json.dumps(js, indent=4, ensure_ascii=False)}")
+        if max_tokens > 0:
+            total = sum(messages_tokens)
+            drop = 0
+            while total > max_tokens and drop < len(messages) - 1:
+                total -= messages_tokens[drop]
+                drop += 1
+            if drop:
+                log_dbg(f"trim running messages: drop {drop}/{len(messages)}, tokens: {total}")
+                messages = messages[drop:]
+                messages_tokens = messages_tokens[drop:]
+        self.running_messages_tokens = sum(messages_tokens)
+
+        if log_dbg_enable():
+            for msg in messages:
+                log_dbg(f"{msg['role']}:\n{msg['content']}")
 
         return messages
 
+    def __finish_stream_parser(self, tsc: TaskStreamContext, answer: str) -> Any:
+        """
+        流式解析中途停下的话把剩下的内容继续喂给同一个解析器, 解析完整就直接返回解析结果,
+        这样整份回复只解析一次. 不是干净的 JSON 列表就返回 None, 交给 task_dispatch 自己解析.
+        """
+        jss = tsc.jss
+        if jss.error or jss.root_stream.type != JsonStreamDataType.ARR:
+            return None
+        if len(answer) < jss.fed:
+            return None
+        try:
+            if not jss.done:
+                for _ in jss.parser(answer[jss.fed :]):
+                    pass
+            # 有字段被跳过的话解析结果不完整, 不能直接用
+            if not jss.done or jss.skipped or len(answer[jss.offset :].strip()):
+                return None
+            return jss.data
+        except Exception as e:
+            log_dbg(f"fail to finish stream parser: {e}")
+            return None
+
     def ask(self, caller: Bot, ask_data: BotAskData) -> Generator[dict, None, None]:
         answer = {"code": 1, "message": ""}
 
         self.task_has_change = True
+        model = ask_data.model
+        model_info = self.target_to_model_info(model)
+        # running 的缓存 token 数, Guidance 和预算都按目标模型的分词方式算
+        self.running.set_model(model_info.get("model", ""))
+
+        # 请求前按模型的上下文窗口检查 token, 超了就先裁剪 running, 还超就不发送.
+        budget = 0
+        if model_info.get("max_tokens", 0) > 0:
+            budget = model_info["max_tokens"] - model_info.get("reply_tokens", 1024)
+
         link_think = self.make_link_think(
-            ask_data.model, ask_data.question, ask_data.aimi_name, ask_data.preset
+            ask_data.model,
+            ask_data.question,
+            ask_data.aimi_name,
+            ask_data.preset,
+            max_tokens=0 if self.use_talk_messages else budget,
         )
-        model = ask_data.model
+        link_tokens = self.link_think_tokens
 
         if self.use_talk_messages:
-            running_messages = self.action_running_to_messages()
+            running_messages = self.action_running_to_messages(
+                max(budget - link_tokens, 1) if budget else 0
+            )
             context_messages = make_context_messages("", link_think, running_messages)
 
-            self.now_ctx_size = len(str(link_think)) + len(str(running_messages))
+            self.now_ctx_size = link_tokens + self.running_messages_tokens
         else:
             context_messages = make_context_messages(
                 "",
                 link_think,
             )
-            self.now_ctx_size = len(str(link_think))
-        
-        model_info = self.target_to_model_info(model)
+            self.now_ctx_size = link_tokens
+
+        if budget and self.now_ctx_size > budget:
+            err = f"context tokens {self.now_ctx_size} > budget {budget} of {model_info.get('model', '')}"
+            log_err(err)
+            yield {"code": -1, "message": f"**Context Overflow:** {err}\n\n"}
+            return
+
         timeout = ask_data.timeout if ask_data.timeout > 0 else self.timeout
 
         ask_data = BotAskData(
@@ -2563,7 +2807,8 @@ def chat_from(request: dict = None):
 
             if not tsc.done:  # 如果解析完成了, 则说明不需要再继续处理.
 
-                for talk in self.task_dispatch(res["message"]):
+                stream_data = self.__finish_stream_parser(tsc, res["message"])
+                for talk in self.task_dispatch(res["message"], stream_data):
                     if isinstance(talk, str):
                         talk_cache += talk
                     else:
@@ -2585,12 +2830,27 @@ def chat_from(request: dict = None):
         yield answer
 
     def get_all_action(self) -> Dict[str, ActionToolItem]:
-        actions = {}
-        for action in self.extern_action.brief():
-            actions[action.call] = action
-        for action in self.action_tools:
-            actions[action.call] = action
-        return actions
+        # 返回的字典是共享的, 不要修改; 动作变化时把 __action_registry 置空就会重建.
+        if self.__action_registry is None:
+            actions = {}
+            for action in self.extern_action.brief():
+                actions[action.call] = action
+            for action in self.action_tools:
+                actions[action.call] = action
+            self.__action_registry = actions
+            self.__builtin_calls = {action.call for action in self.action_tools}
+            self.__extern_calls = {
+                call: action_call
+                for call, action_call in self.extern_action.actions.items()
+                if call not in self.__builtin_calls
+            }
+            log_dbg(f"build action registry: {len(actions)} actions")
+        return self.__action_registry
+
+    def get_extern_calls(self) -> Dict[str, ActionCall]:
+        # 分发用所有外部动作, brief() 只决定 Guidance 里列出哪些. 和动作表一起重建.
+        self.get_all_action()
+        return self.__extern_calls
 
     def update_new_timestamp(self):
         max_timestamp = 0
@@ -2601,7 +2861,7 @@ def chat_from(request: dict = None):
         self.timestamp = max_timestamp + 1
 
     def make_link_think(
-        self, model: str, question: str, aimi_name: str, preset: str
+        self, model: str, question: str, aimi_name: str, preset: str, max_tokens: int = 0
     ) -> str:
         # 如果只是想让任务继续, 就回复全空格/\t/\n
         if question.isspace():
@@ -2624,12 +2884,75 @@ def chat_from(request: dict = None):
 
         if aimi_name and isinstance(aimi_name, str) and len(aimi_name):
             self.aimi_name = aimi_name
+
+        template = self.__get_guidance_template(aimi_name)
+
+        values = {
+            "timestamp": str(self.timestamp),
+            "timestamp_m1": str(self.timestamp - 1),
+            "timestamp_m2": str(self.timestamp - 2),
+            "timestamp_p2": str(self.timestamp + 2),
+            "now_task_id": json.dumps(self.now_task_id, ensure_ascii=False),
+            "task_list": json.dumps(self.__make_task_list(), ensure_ascii=False),
+            "preset": json.dumps(preset, ensure_ascii=False),
+            "note": json.dumps(self.notes, ensure_ascii=False),
+        }
+        token_model = self.running.model
+        if not self.use_talk_messages:
+            values["action_running"] = "[]"
+            static_tokens = self.__count_guidance_tokens(template, values, token_model)
+            if max_tokens > 0:
+                running, running_tokens = self.__trim_running(max_tokens - static_tokens)
+            else:
+                running = list(self.running)
+                running_tokens = self.running.tokens + len(running)
+            values["action_running"] = running_to_json(running)
+            self.link_think_tokens = static_tokens + running_tokens
+        else:
+            self.link_think_tokens = self.__count_guidance_tokens(template, values, token_model)
+
+        setting_format = template.render(values)
+
+        if log_dbg_enable():
+            log_dbg(f"now setting: {setting_format}")
+
+        return setting_format
+
+    def __count_guidance_tokens(
+        self, template: JsonTemplate, values: Dict[str, str], model: str
+    ) -> int:
+        # 模板固定部分的 token 数跟模板一起缓存, 每次只数动态字段. 分段计数和整段计数只差几个 token.
+        encoding = encoding_name(model)
+        static_tokens = self.__guidance_tokens.get(encoding, None)
+        if static_tokens is None:
+            static_tokens = count_tokens("".join(template.parts), model)
+            self.__guidance_tokens[encoding] = static_tokens
+        return static_tokens + sum(count_tokens(values[key], model) for key in template.keys)
+
+    def __get_guidance_template(self, aimi_name: str) -> JsonTemplate:
+        """
+        Guidance 里除了时间戳/任务/备注/预设/运行记录之外都是固定的,
+        只在名字, 动作列表或者配置变化时重新生成, 平时只做字符串拼接.
+        """
+        actions = self.get_all_action()
+        cache_key = (
+            aimi_name,
+            self.aimi_name,
+            self.master_name,
+            self.use_talk_messages,
+            self.prompt_cache,
+        )
+        cache = self.__guidance_cache
+        # 动作表只在动作增删时重建, 所以比较是不是同一个对象就够了
+        if cache and cache[0] == cache_key and cache[1] is actions:
+            return cache[2]
+
         aimi_core_name = aimi_name + "Core"
 
         action_tools = []
         execute_ai_calls = []
         execute_system_calls = []
-        for call, action in self.get_all_action().items():
+        for call, action in actions.items():
             action_tools.append(action.dict())
             if "AI" == action.execute:
                 execute_ai_calls.append(call)
@@ -2639,14 +2962,24 @@ def chat_from(request: dict = None):
         self.execute_ai_calls = execute_ai_calls
         self.execute_system_calls = execute_system_calls
 
-        task_list = self.__make_task_list()
         master_name = "kei"
+        if self.prompt_cache:
+            # 规则里不写具体的时间, 改成引用最后的 timestamp 字段, 这样前缀每轮都不变.
+            ts = "当前 timestamp"
+            ts_m1 = "当前 timestamp-1"
+            ts_m2 = "当前 timestamp-2"
+            ts_p2 = "当前 timestamp+2"
+        else:
+            ts = JsonTemplate.text("timestamp")
+            ts_m1 = JsonTemplate.text("timestamp_m1")
+            ts_m2 = JsonTemplate.text("timestamp_m2")
+            ts_p2 = JsonTemplate.text("timestamp_p2")
 
         action_object = {
             "type": "object",
             "description": "action的使用描述: "
                 f"在回答中，不能直接复制原始的字段内容，而是需要根据最关键的信息和最新的内容进行填充，使回复尽可能地具有合适的细节和结构. ",
-            "timestamp": self.timestamp,
+            "timestamp": JsonTemplate.value("timestamp"),
             "expect": "期望: 现在最可能期望达到什么目标. 如: 想聊天. ",
             "reasoning": f"逻辑思考: 思考要如何做、怎么做的原因、依据是什么、范围是什么等. 如: 为了实现 `expect` 和 {self.master_name} 聊天, 根据 Guidance 中的 action_rule 规则中 "
                 f"提供的 action_tools 里面有关聊天动作的说明, 使用 chat_to_{self.master_name.lower()} 进行聊天交互. 尝试解答 {self.master_name} 的疑问. ",
@@ -2656,7 +2989,7 @@ def chat_from(request: dict = None):
                 "description": "call的请求参数.",
                 "from": [
                     f"关联动作的 timestamp: 表示和哪个动作有关联, 和现在的timestamp没关系, 不可省略. "
-                    f"如可分别填: {self.timestamp-2} {self.timestamp-1} 等. ",
+                    f"如可分别填: {ts_m2} {ts_m1} 等. ",
                 ],
                 "action_tools 中的 call 对应的请求参数": "请求参数对应的合适内容",
             },
@@ -2668,7 +3001,7 @@ def chat_from(request: dict = None):
         settings: Dict = {
             "type": "object",
             "description": f"{aimi_core_name} Guidance.",
-            "timestamp": self.timestamp,
+            "timestamp": JsonTemplate.value("timestamp"),
             "core": [
                 f"1. 指导开始: 你需要完全理解 {aimi_core_name} Guidance . ",
                 f"2. 时间定义: timestamp 是时间, 你对于时间的感知在 timestamp_rule 中定义. ",
@@ -2696,10 +3029,10 @@ def chat_from(request: dict = None):
             "action_format": action_object,
             "timestamp_rule": [
                 f"1. 运行时间: 你参考时间 timestamp 运行. ",
-                f"2. 时间行动: 你从最新时间(也比我的时间新新.), 也就是 timestamp={self.timestamp} 开始产生行动. "
+                f"2. 时间行动: 你从最新时间(也比我的时间新新.), 也就是 timestamp={ts} 开始产生行动. "
                     f"你新时刻要有新操作. 你可以在新的timestamp回复, 却不能在旧的timestamp回复, 如果出现了更新的timestamp, "
                     f"则你需要把自己的timestamp设置成比这更新的值. 重新回复旧问题也要用新的时间戳. ",
-                f"3. 时间范围: 你每次只能在 {self.timestamp} <= timestamp <= {self.timestamp+2} 之间进行行动. ",
+                f"3. 时间范围: 你每次只能在 {ts} <= timestamp <= {ts_p2} 之间进行行动. ",
             ],
             "information_rule": [
                 f"1. 基于所有已经产生的信息运行. ",
@@ -2754,8 +3087,8 @@ def chat_from(request: dict = None):
             ],
             "task": {
                 "type": "object",
-                "now_task_id": self.now_task_id,
-                "task_list": task_list,
+                "now_task_id": JsonTemplate.value("now_task_id"),
+                "task_list": JsonTemplate.value("task_list"),
             },
             "mock_rule": [
                 f"1. 什么是模拟对象: 模拟对象是指在某种预设下预测对象的可能行为和能力的一种交互行为. ",
@@ -2776,19 +3109,28 @@ def chat_from(request: dict = None):
                 f"2. 对象权限规则: 你在模拟/扮演 preset 中的 对象 的同时会始终遵守 {self.aimi_name}Core Guidance. ",
                 f"3. 尝试多种方法: 你要极力避免陷入死循环(你喜欢新事物, 你厌倦机械重复.). 你在模拟对象时, 也需要尝试不同方法. ",
             ],
-            "preset": preset,
+            "preset": JsonTemplate.value("preset"),
             "action_tools": action_tools,
-            "note": self.notes,
+            "note": JsonTemplate.value("note"),
         }
 
         if not self.use_talk_messages:
-            settings["action_running"] = [item.dict() for item in self.running]
+            settings["action_running"] = JsonTemplate.value("action_running")
 
-        setting_format = json.dumps(settings, ensure_ascii=False)
+        if self.prompt_cache:
+            # 上游按前缀缓存: 不变的规则/动作列表放前面, 会变的放最后,
+            # 越常变的越靠后, action_running 只会追加, 放在 timestamp 前面.
+            action_object["timestamp"] = f"时间: 填 {ts} 到 {ts_p2} 之间的值. "
+            for key in ["preset", "task", "note", "action_running", "timestamp"]:
+                if key in settings:
+                    settings[key] = settings.pop(key)
 
-        log_dbg(f"now setting: {json.dumps(settings, indent=4, ensure_ascii=False)}")
+        template = JsonTemplate(settings)
+        self.__guidance_cache = (cache_key, actions, template)
+        self.__guidance_tokens = {}
+        log_dbg(f"make guidance template: {len(action_tools)} actions")
 
-        return setting_format
+        return template
 
     def __make_task_list(self) -> Dict:
         if not (self.now_task_id in self.tasks):
@@ -2800,4 +3142,37 @@ def chat_from(request: dict = None):
         return [task.dict() for _, task in self.tasks.items()]
 
     def set_running(self, api_response):
-        self.running = json.loads(api_response)
+        self.running = TaskRunning(
+            [TaskRunningItem(**run) for run in json.loads(api_response)]
+        )
+
+
+def benchmark_prompt_cache(task: Task, turns: int = 8, preset: str = "") -> Dict[str, float]:
+    """
+    模拟连续几轮对话, 统计相邻两轮 Guidance 字节级相同前缀的占比, 对比 prompt_cache 开关.
+    """
+    running = list(task.running)
+    timestamp = task.timestamp
+    prompt_cache = task.prompt_cache
+
+    report = {}
+    for enable in [False, True]:
+        task.prompt_cache = enable
+        prev = b""
+        shares = []
+        for turn in range(turns):
+            link_think = task.make_link_think(
+                "", f"第 {turn} 轮: 你好", task.aimi_name, preset
+            ).encode("utf-8")
+            if prev:
+                prefix = os.path.commonprefix([prev, link_think])
+                shares.append(len(prefix) / len(link_think))
+            prev = link_think
+        report[f"prompt_cache={enable}"] = sum(shares) / len(shares) if shares else 0
+        task.running = TaskRunning(running)
+        task.timestamp = timestamp
+
+    task.prompt_cache = prompt_cache
+    for name, share in report.items():
+        log_info(f"{name}: stable prefix {share * 100:.1f}%")
+    return report
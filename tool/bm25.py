@@ -0,0 +1,107 @@
+import re
+import math
+import threading
+from collections import Counter
+from typing import Dict, List, Tuple
+
+
+def char_ngrams(text: str, ngram: int = 2) -> List[str]:
+    # 中文短句没有分词, 直接用字符 bigram; 只有一个字的时候退化成单字.
+    text = re.sub(r"[\W_]+", "", text.lower())
+    if len(text) <= ngram:
+        return [text] if text else []
+    return [text[i : i + ngram] for i in range(len(text) - ngram + 1)]
+
+
+class BM25Index:
+    """
+    按槽位维护的字符 n-gram BM25 倒排索引.
+    add 时先删掉这个槽位的旧文档, 增删只涉及这条文本自己的词, 查询只遍历查询词的倒排表.
+    """
+
+    k1: float = 1.2
+    b: float = 0.75
+
+    def __init__(self, size: int, ngram: int = 2):
+        self.size = size
+        self.ngram = ngram
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_terms: List[Counter] = [None] * size
+        self.doc_len = [0] * size
+        self.total_len = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, slot: int, text: str):
+        terms = Counter(char_ngrams(text, self.ngram))
+        with self.lock:
+            self.__remove(slot)
+            for term, tf in terms.items():
+                self.postings.setdefault(term, {})[slot] = tf
+            self.doc_terms[slot] = terms
+            self.doc_len[slot] = sum(terms.values())
+            self.total_len += self.doc_len[slot]
+            self.count += 1
+
+    def remove(self, slot: int):
+        with self.lock:
+            self.__remove(slot)
+
+    def __remove(self, slot: int):
+        terms = self.doc_terms[slot]
+        if terms is None:
+            return
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(slot, None)
+            if not posting:
+                del self.postings[term]
+        self.doc_terms[slot] = None
+        self.total_len -= self.doc_len[slot]
+        self.doc_len[slot] = 0
+        self.count -= 1
+
+    def search(self, query: str, limit: int = 32) -> List[Tuple[int, float]]:
+        terms = Counter(char_ngrams(query, self.ngram))
+        scores: Dict[int, float] = {}
+        with self.lock:
+            if not self.count:
+                return []
+            avg_len = self.total_len / self.count
+            for term, qtf in terms.items():
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                df = len(posting)
+                idf = math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+                for slot, tf in posting.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_len[slot] / avg_len)
+                    scores[slot] = scores.get(slot, 0.0) + qtf * idf * tf * (self.k1 + 1) / (
+                        tf + norm
+                    )
+
+        return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+
+if __name__ == "__main__":
+    import time
+    import random
+
+    size = 10000
+    words = "摸头耳朵尾巴天气下雨出门散步吃饭睡觉代码排序数学公式猫娘主人今天明天喜欢"
+    random.seed(0)
+    texts = ["".join(random.choice(words) for _ in range(30)) for _ in range(size)]
+
+    index = BM25Index(size)
+    start = time.time()
+    for slot, text in enumerate(texts):
+        index.add(slot, text)
+    print(f"add: {(time.time() - start) / size * 1e6:.1f} us/item")
+
+    start = time.time()
+    for _ in range(100):
+        index.search("摸摸耳朵")
+    print(f"search: {(time.time() - start) / 100 * 1000:.2f} ms/query")
+    print(index.search("摸摸耳朵", 3))
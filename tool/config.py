@@ -1,5 +1,6 @@
-from typing import Dict, List
+from typing import Dict, List, Generator
 import random
+import json
 import os
 
 from tool.util import read_yaml, log_dbg, log_err
@@ -54,7 +55,10 @@ class Config:
     go_cqhttp_config: str = "./run/config.yml"
     setting_config: str = "./run/setting.yml"
     memory_config: str = "./run/memory.yml"
+    memory_journal: str = "./run/memory.journal"
+    memory_path: str = "./run/memory"
     memory_model_file: str = "./run/memory.pt"
+    memory_vector_file: str = "./run/memory.vec"
     task_config_name: str = "task.yml"
     database_path: str = "./run/database"
     setting: dict = {}
@@ -90,9 +94,9 @@ class Config:
             log_dbg(f"fail to create: {e}")
 
     @classmethod
-    def load_memory(cls) -> dict:
+    def load_memory(cls, memory_config: str = "") -> dict:
         try:
-            obj = read_yaml(Config.memory_config)
+            obj = read_yaml(memory_config if memory_config else Config.memory_config)
             mem = {}
             mem["openai_conversation_id"] = obj.get("openai_conversation_id", "")
             mem["idx"] = obj.get("idx", 0)
@@ -120,6 +124,24 @@ class Config:
             log_err("fail to load memory: " + str(e))
             return {}
 
+    @classmethod
+    def load_memory_journal(cls, journal_file: str) -> Generator[dict, None, None]:
+        if not os.path.exists(journal_file):
+            return
+
+        try:
+            with open(journal_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except Exception as e:
+                        # 异常退出时最后一行可能没写完, 跳过即可.
+                        log_err(f"skip broken journal record: {e}")
+        except Exception as e:
+            log_err(f"fail to load memory journal: {e}")
+
     @classmethod
     def load_task(cls, data_path="./run/database/default") -> dict:
         try:
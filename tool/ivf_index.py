@@ -0,0 +1,171 @@
+import os
+import numpy as np
+from typing import List, Tuple
+
+from tool.util import log_dbg, log_err
+
+
+class IVFIndex:
+    """
+    倒排文件 (IVF) 近似最近邻: k-means 把向量分到 nlist 个簇, 查询时只扫最近的 nprobe 个簇.
+    向量都是单位长度, 相似度用内积.
+    插入时分到最近的簇后追加到该簇的列表末尾, O(nlist * dim); 槽位被覆盖时旧记录惰性删除,
+    查询时按 assign 过滤, 累计插入超过容量后整体压缩一次.
+    """
+
+    nprobe: int = 16
+    nlist: int = 0
+    centroids: np.ndarray = None
+    keys: np.ndarray = None
+
+    def __init__(self, size: int, dim: int, nprobe: int = 16):
+        self.size = size
+        self.dim = dim
+        self.nprobe = nprobe
+        self.assign = np.full(size, -1, dtype=np.int32)
+        self.lists: List[np.ndarray] = []
+        self.list_len = np.zeros(0, dtype=np.int64)
+        self.garbage = 0
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    @staticmethod
+    def suggest_nlist(count: int) -> int:
+        return int(min(4096, max(16, np.sqrt(count))))
+
+    def train(self, sample: np.ndarray, nlist: int, iters: int = 10, seed: int = 0):
+        # 球面 k-means, 只用采样的向量训练簇中心
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(sample, dtype=np.float32)
+        nlist = min(nlist, len(sample))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+        for _ in range(iters):
+            labels = self.__nearest(centroids, sample)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.maximum(norms, 1e-12)
+
+        self.centroids = centroids.astype(np.float32)
+        self.nlist = nlist
+        log_dbg(f"train ivf: nlist {nlist}, sample {len(sample)}")
+
+    @staticmethod
+    def __nearest(centroids: np.ndarray, vectors: np.ndarray, chunk: int = 65536) -> np.ndarray:
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            part = np.asarray(vectors[start : start + chunk], dtype=np.float32)
+            labels[start : start + chunk] = np.argmax(part @ centroids.T, axis=1)
+        return labels
+
+    def build(self, matrix: np.ndarray, slots: np.ndarray):
+        # 把已有向量一次性分簇
+        self.assign[:] = -1
+        if len(slots):
+            self.assign[slots] = self.__nearest(self.centroids, matrix[slots])
+        self.__rebuild_lists()
+
+    def __rebuild_lists(self):
+        slots = np.flatnonzero(self.assign >= 0)
+        labels = self.assign[slots]
+        order = np.argsort(labels, kind="stable")
+        slots, labels = slots[order], labels[order]
+        bounds = np.searchsorted(labels, np.arange(self.nlist + 1))
+
+        self.lists = []
+        for l in range(self.nlist):
+            ids = slots[bounds[l] : bounds[l + 1]].astype(np.int32)
+            buf = np.empty(max(16, 2 * len(ids)), dtype=np.int32)
+            buf[: len(ids)] = ids
+            self.lists.append(buf)
+        self.list_len = np.diff(bounds).astype(np.int64)
+        self.garbage = 0
+
+    def add(self, slot: int, vec: np.ndarray):
+        if not self.trained:
+            return
+        l = int(np.argmax(self.centroids @ vec))
+        if self.assign[slot] >= 0:
+            self.garbage += 1
+        self.assign[slot] = l
+
+        n = self.list_len[l]
+        buf = self.lists[l]
+        if n >= len(buf):
+            grown = np.empty(2 * len(buf), dtype=np.int32)
+            grown[:n] = buf[:n]
+            self.lists[l] = buf = grown
+        buf[n] = slot
+        self.list_len[l] = n + 1
+
+        # 旧记录太多就整体压缩, 均摊 O(1)
+        if self.garbage > self.size:
+            self.__rebuild_lists()
+
+    def remove(self, slot: int):
+        if self.assign[slot] >= 0:
+            self.assign[slot] = -1
+            self.garbage += 1
+
+    def candidates(self, query: np.ndarray, nprobe: int = 0) -> np.ndarray:
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        scores = self.centroids @ query
+        probe = np.argpartition(-scores, nprobe - 1)[:nprobe]
+
+        ids = np.concatenate([self.lists[l][: self.list_len[l]] for l in probe])
+        if not self.garbage:
+            return ids
+        # 过滤掉已经被覆盖或者搬到别的簇的旧记录
+        labels = np.repeat(probe, self.list_len[probe])
+        return np.unique(ids[self.assign[ids] == labels])
+
+    def search(
+        self, matrix: np.ndarray, query: np.ndarray, k: int, nprobe: int = 0
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ids = self.candidates(query, nprobe)
+        if not len(ids):
+            return ids, np.zeros(0, dtype=np.float32)
+        scores = np.asarray(matrix[ids], dtype=np.float32) @ query
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return ids[top], scores[top]
+
+    def save(self, file: str, keys: np.ndarray = None) -> bool:
+        # keys 是保存时每个槽位的内容指纹, 加载后用来找出之后变过的槽位
+        if not self.trained:
+            return False
+        if keys is None:
+            keys = np.zeros(0, dtype=np.uint32)
+        tmp_file = file + ".tmp.npz"
+        np.savez(tmp_file, centroids=self.centroids, assign=self.assign, keys=keys)
+        os.replace(tmp_file, file)
+        return True
+
+    def load(self, file: str) -> bool:
+        if not os.path.exists(file):
+            return False
+        try:
+            data = np.load(file)
+            centroids, assign = data["centroids"], data["assign"]
+            keys = data["keys"] if "keys" in data else None
+        except Exception as e:
+            log_err(f"fail to load ivf index: {e}")
+            return False
+        if centroids.shape[1] != self.dim or len(assign) != self.size:
+            log_dbg(f"ivf index shape changed, rebuild: {file}")
+            return False
+
+        self.centroids = centroids.astype(np.float32)
+        self.nlist = len(centroids)
+        self.assign = assign.astype(np.int32)
+        self.keys = keys if keys is not None and len(keys) == self.size else None
+        self.__rebuild_lists()
+        return True
@@ -1,3 +1,5 @@
+import re
+import fnmatch
 from typing import Dict, Any, List, Generator, Optional, Union, Set
 from tool.util import log_dbg
 import codecs
@@ -22,6 +24,76 @@ class JsonStreamDataType:
     ALL = {"arr": 0, "bol": 0, "obj": 0, "num": 0, "nul": 0, "str": 0}
 
 
+# 值的第一个字符决定类型
+JSON_STREAM_PARSER_TYPE = {
+    "{": JsonStreamDataType.OBJ,
+    "[": JsonStreamDataType.ARR,
+    '"': JsonStreamDataType.STR,
+    "t": JsonStreamDataType.BOL,
+    "f": JsonStreamDataType.BOL,
+    "n": JsonStreamDataType.NUL,
+    "-": JsonStreamDataType.NUM,
+    **{str(num): JsonStreamDataType.NUM for num in range(0, 10)},
+}
+
+JSON_STREAM_ESCAPE = {
+    "\\": "\\",
+    '"': '"',
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+JSON_STREAM_PATH_SEGMENT = re.compile(r'\[(\*|\d+|"((?:[^"\\]|\\.)*)")\]')
+
+
+class JsonStreamState:
+    VALUE = 0  # 等待一个值
+    STR = 1  # 字符串内容 (值或者 key)
+    STR_ESC = 2  # 字符串里 \ 后面的字符
+    STR_UNICODE = 3  # \uXXXX 的 4 位十六进制
+    LITERAL = 4  # 数字 / true / false / null
+    OBJ_KEY = 5  # { 或 , 之后, 等待 key 或 }
+    OBJ_COLON = 6  # key 之后, 等待 :
+    OBJ_NEXT = 7  # 成员之后, 等待 , 或 }
+    ARR_ITEM = 8  # [ 或 , 之后, 等待元素或 ]
+    ARR_NEXT = 9  # 元素之后, 等待 , 或 ]
+    DONE = 10
+    ERROR = 11
+    SKIP_VALUE = 12  # 没订阅的值, 等待第一个字符
+    SKIP = 13  # 没订阅的容器内部, 只数括号深度
+    SKIP_STR = 14
+    SKIP_ESC = 15
+    SKIP_LITERAL = 16
+
+
+def compile_path_pattern(pattern: str) -> List[Union[str, int, None]]:
+    """
+    把 json[*]["request"]["content"] 这样的路径模式拆成每一层的匹配条件:
+    [*] 匹配任意下标或 key, [0] 匹配下标, ["key"] 匹配 key (支持 fnmatch 通配符).
+    """
+    if not pattern.startswith(JsonStreamRoot.Root):
+        raise Exception(f"path pattern must start with {JsonStreamRoot.Root}: {pattern}")
+    segments = []
+    pos = len(JsonStreamRoot.Root)
+    while pos < len(pattern):
+        match = JSON_STREAM_PATH_SEGMENT.match(pattern, pos)
+        if not match:
+            raise Exception(f"invalid path pattern: {pattern}")
+        if match.group(1) == "*":
+            segments.append(None)
+        elif match.group(2) is not None:
+            segments.append(match.group(2))
+        else:
+            segments.append(int(match.group(1)))
+        pos = match.end()
+    return segments
+
+
 class JsonStreamData:
     type: str
     __data: Any = ""
@@ -33,14 +105,48 @@ class JsonStreamData:
 
     now_arr_cnt = 0
     now_key = ""
-    key_start = 0
-    key_end = 0
-    colon_offset = 0
-    val_start = 0
-    val_end = 0
+    # 订阅模式下只是为了通向订阅路径才解析的容器: 还在匹配中的 (模式, 层) 列表, None 表示整个都订阅了
+    watch: Optional[tuple] = None
 
     def set_data(self, val):
         self.__data = val
+        self.__parts = []
+        self.__size = len(val) if isinstance(val, (str, list, dict)) else 0
+
+    def append_str(self, text: str):
+        # 字符串分段收集, 用到 data 的时候再拼起来
+        self.__parts.append(text)
+        self.__size += len(text)
+
+    # 容器同时维护子节点和对应的 Python 对象, 子节点完成时把值写进去,
+    # 解析是顺序的, 同一时间最多只有一个子节点没完成, 读 data 时只刷新它.
+    def add_child(self, key: Union[str, int], child: "JsonStreamData"):
+        if self.type == JsonStreamDataType.OBJ:
+            self.__data[key] = child
+            self.__value[key] = None
+            self.__open_key = key
+        else:
+            self.__data.append(child)
+            self.__value.append(None)
+            self.__open_key = len(self.__value) - 1
+        self.__open = child
+
+    def remove_child(self, child: "JsonStreamData"):
+        if self.__open is not child:
+            return
+        if self.type == JsonStreamDataType.OBJ:
+            self.__data.pop(self.__open_key, None)
+            self.__value.pop(self.__open_key, None)
+        else:
+            self.__data.pop()
+            self.__value.pop()
+        self.__open = None
+
+    def child_done(self, child: "JsonStreamData"):
+        if self.__open is not child:
+            return
+        self.__value[self.__open_key] = child.data
+        self.__open = None
 
     def len(self):
         if self.type == JsonStreamDataType.BOL or (
@@ -50,10 +156,13 @@ class JsonStreamData:
         ):
             return None
 
+        if self.type == JsonStreamDataType.STR:
+            return self.__size or None
+
         if not self.__data:
             return None
 
-        return len(self.data)
+        return len(self.__data)
 
     def str(self):
         if self.type == JsonStreamDataType.ARR:
@@ -77,27 +186,25 @@ class JsonStreamData:
                 cnt += 1
             return res + " }"
         else:
-            return str(self.__data)
+            return str(self.data)
 
     @property
     def data(self):
-        if self.type == JsonStreamDataType.ARR:
-            arr = []
-            for item in self.__data:
-                item: "JsonStreamData"
-                arr.append(item.data)
-            return arr
-        elif self.type == JsonStreamDataType.OBJ:
-            dict = {}
-            for k, v in self.__data.items():
-                v: "JsonStreamData"
-                dict[k] = v.data
-            return dict
+        # 容器返回的是同一个对象, 会随着解析继续更新, 要改的话先复制一份.
+        if self.type == JsonStreamDataType.ARR or self.type == JsonStreamDataType.OBJ:
+            if self.__open is not None:
+                self.__value[self.__open_key] = self.__open.data
+            return self.__value
+        elif self.type == JsonStreamDataType.STR and self.__parts:
+            self.__data += "".join(self.__parts)
+            self.__parts = []
 
         return self.__data
 
     @property
     def stream_data(self) -> "JsonStreamData":
+        if self.type == JsonStreamDataType.STR:
+            return self.data
         return self.__data
 
     def __init__(self, type, path) -> None:
@@ -109,13 +216,20 @@ class JsonStreamData:
         self.type = type
         self.done = False
         self.now_arr_cnt = 0
+        self.chunk = ""
+        self.__parts: List[str] = []
+        self.__size = 0
+        self.__open: Optional["JsonStreamData"] = None
+        self.__open_key: Union[str, int] = 0
 
         if type == JsonStreamDataType.ARR:
             self.__data = []
+            self.__value = []
         elif type == JsonStreamDataType.BOL:
             self.__data = False
         elif type == JsonStreamDataType.OBJ:
             self.__data = {}
+            self.__value = {}
         elif type == JsonStreamDataType.NUM:
             self.__data = 0
         elif type == JsonStreamDataType.NUL:
@@ -128,36 +242,94 @@ class JsonStreamData:
         self.type_parser_reset()
 
     def type_parser_reset(self):
-        log_dbg(f"clear {self.type}: {self.now_key} parser cache. ")
         self.now_key = ""
-        self.key_start = 0
-        self.key_end = 0
-        self.colon_offset = 0
-        self.val_start = 0
-        self.val_end = 0
 
 
 class JsonStream:
+    """
+    增量 JSON 解析. 显式状态机, 每个字符只看一次, 字符串按段收集,
+    所以不管输入怎么切块, 总开销都和输入长度成线性关系.
+    parser() 每次输入后上报: 完成的值 (标量和容器), 以及还没解析完的标量 (chunk 是这次新增的内容).
+
+    subscribe 给了路径模式的话只解析订阅的值和它们的子树, 通往订阅路径的容器只保留订阅到的成员,
+    不上报; 其他值在词法层面直接跳过, 不创建对象也不拼路径, skipped 记录跳过了多少个值.
+
+    输入解析完就丢掉, 只留下还没解析的尾巴 (调用方中途停下时), 没解析完的 token 只保留它自己的内容.
+    注意解析出来的值都留在树和 stream_map 里, 不订阅的时候内存还是随输入长度增长;
+    只有订阅了路径, 而且订阅的值本身不大 (如 benchmark_memory 只订阅 call) 时, 内存才基本不随输入增长.
+    offset / base / fed 都是在整个输入里的绝对位置: 已解析到哪里 / buf[0] 在哪里 / 一共收到多少.
+
+    parser() 也可以直接喂网络上收到的 bytes, 按 UTF-8 增量解码, 被切开的多字节字符会等下一块补齐.
+    位置都按解码后的字符计算.
+
+    比旧版严格: 数组/对象最后多一个逗号可以接受, 其他不合法的输入 (缺逗号, 单引号, 没有引号的 key,
+    写错的 true/false/null 等) 会进入错误状态, parser() 抛异常, error 里是原因, 之后的输入不再解析.
+    旧版遇到这些会继续往下走, 得到的结果也是错的. 调用方需要自己回退到完整文本的宽松解析.
+    """
+
     done: bool = False
     path = JsonStreamRoot.Root
 
-    buf: str = ""
     offset: int = 0
+    base: int = 0
+    fed: int = 0
     stream_map: Dict[str, JsonStreamData]
 
-    def __init__(self):
+    __space = re.compile(r"[ \t\n\r]*")
+    __str_special = re.compile(r'["\\]')
+    __skip_special = re.compile(r'[\[\]{}"]')
+    __literal = re.compile(r"[^,\]}: \t\n\r]*")
+    __int = re.compile(r"-?\d+")
+
+    def __init__(self, subscribe: Optional[List[str]] = None):
         self.stream_map = {}
+        self.done = False
+        self.path = JsonStreamRoot.Root
+        self.offset = 0
+        self.base = 0
+        self.fed = 0
+        self.error = ""
+        self.skipped = 0
         stream = JsonStreamData(JsonStreamDataType.UND, self.path)
         stream.parent = stream
         self.stream_map[JsonStreamRoot.Root] = stream
 
+        self.__pending = ""
+        self.__decoder = codecs.getincrementaldecoder("utf-8")()
+        self.__state = JsonStreamState.VALUE
+        self.__stream = stream  # 当前最里层还没解析完的值
+        self.__in_key = False
+        self.__key_parts: List[str] = []
+        self.__key = ""
+        self.__chunk_parts: List[str] = []
+        self.__literal_parts: List[str] = []
+        self.__unicode = ""
+        self.__high_surrogate = 0
+        self.__skip_depth = 0
+        self.__patterns: List[List[Union[str, int, None]]] = []
+        if subscribe:
+            self.subscribe(subscribe)
+
+    def subscribe(self, patterns: List[str]):
+        # 要在开始解析之前调用
+        self.__patterns = [compile_path_pattern(pattern) for pattern in patterns]
+        if any(not len(segments) for segments in self.__patterns):
+            self.root_stream.watch = None
+        else:
+            self.root_stream.watch = tuple((idx, 0) for idx in range(len(self.__patterns)))
+
+    @property
+    def buf(self) -> str:
+        # 还没解析的部分, buf[0] 对应输入里的 base
+        return self.__pending
+
     def is_path(self, path=""):
         if self.path == path:
             return True
         return False
 
     def need_skip_char(self, ch) -> bool:
-        if ch == " " or ch == "\n" or ch == "\t":
+        if ch == " " or ch == "\n" or ch == "\t" or ch == "\r":
             return True
         return False
 
@@ -173,168 +345,10 @@ class JsonStream:
     def root_stream(self):
         return self.stream_map[JsonStreamRoot.Root]
 
-    def parser(self, buf: str):
-        if isinstance(buf, str):
-            self.buf += buf
-
-        now_stream = self.stream_map[self.path]
-        log_dbg(f"path: {self.path}")
-
-        cur = len(self.buf) - self.offset
-
-        while cur and self.offset < len(self.buf) and now_stream:
-            cur -= 1
-            log_dbg(f"cur: {cur}, offset: {self.offset}")
-
-            for now_stream in self.parser_buf(now_stream):
-                if not now_stream:
-                    break
-
-                if 'json[0]["request"]' in self.stream_map:
-                    request = self.stream_map['json[0]["request"]']
-                    log_dbg(
-                        f"self.path: {self.path} req path: {request.path} req done {request.done}"
-                    )
-
-                if self.offset >= len(self.buf):
-                    break
-
-                log_dbg(
-                    f"now_path: {self.path}, type: {now_stream.type}, buf: {self.buf[self.offset:]}"
-                )
-
-                if now_stream.done:
-                    break
-
-            log_dbg(
-                f"({self.path}) ({now_stream.path}) {now_stream.type} now_stream: {now_stream}"
-            )
-
-            if now_stream:
-                if now_stream.path == JsonStreamRoot.Root:  # root
-                    self.done = now_stream.done
-
-                if (
-                    now_stream.type != JsonStreamDataType.OBJ
-                    and now_stream.type != JsonStreamDataType.ARR
-                    and now_stream.type != JsonStreamDataType.UND
-                ):
-                    yield now_stream
-
-                if now_stream.done:
-                    if (
-                        now_stream.type == JsonStreamDataType.ARR
-                        or now_stream.type == JsonStreamDataType.OBJ
-                    ):
-                        yield now_stream
-
-                    self.parser_stream_done(now_stream)
-
-            now_stream = self.stream_map[self.path]
-            log_dbg(f"exit. cur: {cur} now_stream: {now_stream}")
-
-    def get_next_parser_path(self, stream: JsonStreamData):
-        if not stream.done:
-            return stream.path
-        if JsonStreamRoot.Root == stream.path:
-            return JsonStreamRoot.Root
-
-        return self.get_next_parser_path(stream.parent)
-
-    def parser_stream_done(self, stream: JsonStreamData):
-        log_dbg(f"check done type: {stream.type}, data: {str(stream.data)}")
-        if not stream.done:
-            return stream
-
-        log_dbg(
-            f"path: {self.path}, type: {stream.type}, "
-            f"offset: {self.offset}, all: {len(self.buf)}, stream done. "
-        )
-
-        if stream.parent.type == JsonStreamDataType.OBJ:
-            stream.parent.type_parser_reset()
-
-        next_parser_path = self.get_next_parser_path(stream)
-        log_dbg(f"update path {self.path} to {next_parser_path}")
-        self.path = next_parser_path
-
-        stream.type_parser_reset()
-
-        # root json
-        return stream
-
     def get_parser_type(self, buf, offset):
         if offset >= len(buf):
             return JsonStreamDataType.UND
-
-        parser_type = {
-            "{": JsonStreamDataType.OBJ,
-            "[": JsonStreamDataType.ARR,
-            '"': JsonStreamDataType.STR,
-            "t": JsonStreamDataType.BOL,
-            "f": JsonStreamDataType.BOL,
-            "n": JsonStreamDataType.NUL,
-        }
-        for num in range(0, 10):
-            parser_type[str(num)] = JsonStreamDataType.NUM
-            parser_type[num] = JsonStreamDataType.NUM
-        parser_type["-"] = JsonStreamDataType.NUM
-
-        type = parser_type.get(buf[offset])
-        if type not in JsonStreamDataType.ALL:
-            return JsonStreamDataType.UND
-
-        log_dbg(f"({self.path}) parser: {buf[offset]}, type: {type}")
-
-        return type
-
-    def parser_buf(self, stream: JsonStreamData):
-        parser_hook = {
-            JsonStreamDataType.OBJ: self.parser_obj,
-            JsonStreamDataType.ARR: self.parser_arr,
-            JsonStreamDataType.STR: self.parser_str,
-            JsonStreamDataType.NUM: self.parser_num,
-            JsonStreamDataType.BOL: self.parser_bol,
-            JsonStreamDataType.NUL: self.parser_nul,
-        }
-        if stream.type in JsonStreamDataType.ALL:
-            hook = parser_hook.get(stream.type)
-            yield from hook(stream)
-        else:
-            yield from self.parser_und(stream)
-
-    def parser_und(self, stream: JsonStreamData):
-        if stream.type == JsonStreamDataType.UND:
-            # 未定义场景, 表示还没开始处理数据. 所以现在进行尝试.
-            while self.offset < len(self.buf) and (
-                self.need_skip_char(self.buf[self.offset])
-            ):
-                self.offset += 1
-
-            if self.offset < len(self.buf):
-                type = self.get_parser_type(self.buf, self.offset)
-                log_dbg(f"({self.path}) check {stream.type} {stream} get type: {type}")
-                if type not in JsonStreamDataType.ALL:
-                    log_dbg(
-                        f"cannot parser , type: {str(type)}, "
-                        f"offset: {self.offset}, all: {len(self.buf)} buf: {self.buf[self.offset:]}"
-                    )
-                else:
-                    stream.reset(type)
-                    log_dbg(f"({self.path}) new stream type: {stream.type} {stream}")
-
-                    if type == JsonStreamDataType.ARR:
-                        self.offset += 1  # 跳过生成过的字符.
-                    elif type == JsonStreamDataType.OBJ:
-                        self.offset += 1  # 跳过生成过的字符.
-                    elif type == JsonStreamDataType.STR:
-                        self.offset += 1  # 跳过生成过的字符.
-                    else:
-                        pass
-
-                    yield from self.parser_buf(stream)
-
-        yield stream
+        return JSON_STREAM_PARSER_TYPE.get(buf[offset], JsonStreamDataType.UND)
 
     def append_stream(self, path, stream) -> JsonStreamData:
         if path not in self.stream_map:
@@ -348,335 +362,528 @@ class JsonStream:
 
         return self.stream_map[path]
 
-    def get_now_parser_obj_stream(self, obj_stream: JsonStreamData):
-        if obj_stream.now_key in obj_stream.stream_data:
-            return obj_stream.stream_data[obj_stream.now_key]
-
-        new_path = f'{self.path}["{obj_stream.now_key}"]'
-        stream = self.get_stream(new_path)
-        stream.parent = obj_stream
-        obj_stream.stream_data[obj_stream.now_key] = stream
-
-        self.path = new_path
-
-        return stream
-
-    def parser_obj(self, obj_stream: JsonStreamData):
-        if obj_stream.type == JsonStreamDataType.OBJ:
-            cur = len(self.buf) - self.offset
-            while cur and self.offset < len(self.buf):
-                cur -= 1
-
-                log_dbg(
-                    f"try parser: {self.buf[self.offset]}, now_offset: {self.offset}, all: {len(self.buf)}"
-                )
-
-                if not obj_stream.key_start:
-                    # 还没解析 key 就到了尾声, 如果结束了的话, 就设置完成.
-                    if self.buf[self.offset] == "}" and self.is_real_ch(
-                        self.buf, self.offset
-                    ):
-                        obj_stream.done = True
-                        self.offset += 1
-                        log_dbg(
-                            f"self.path: {self.path}, obj_stream.path: {obj_stream.path}, "
-                            f"obj_stream done. {obj_stream}"
-                        )
-                        break
-
-                    if self.buf[self.offset] == ",":
-                        self.offset += 1
-                        continue
-
-                    if self.buf[self.offset] == '"':
-                        obj_stream.key_start = self.offset + 1
-                        log_dbg(f"start: {obj_stream.key_start}")
-                    self.offset += 1
-                    continue
-
-                if not obj_stream.key_end:
-                    if self.buf[self.offset] == '"' and self.is_real_ch(
-                        self.buf, self.offset
-                    ):
-                        obj_stream.key_end = self.offset
-                        log_dbg(f"end: {obj_stream.key_end}")
-                    self.offset += 1
-                    continue
-
-                obj_stream.now_key = self.buf[obj_stream.key_start : obj_stream.key_end]
-
-                stream = self.get_now_parser_obj_stream(obj_stream)
-
-                if not obj_stream.colon_offset:
-                    if self.buf[self.offset] == ":":
-                        obj_stream.colon_offset = self.offset
-                    self.offset += 1
+    def parser(self, buf: Union[str, bytes]) -> Generator[JsonStreamData, None, None]:
+        if self.__state == JsonStreamState.ERROR:
+            raise Exception(self.error)
+        if isinstance(buf, (bytes, bytearray, memoryview)):
+            try:
+                buf = self.__decoder.decode(buf)
+            except UnicodeDecodeError as e:
+                self.__state = JsonStreamState.ERROR
+                self.error = f"fail to decode utf-8 at {self.fed}: {e}"
+                raise Exception(self.error)
+        elif not isinstance(buf, str):
+            buf = ""
+        self.fed += len(buf)
+
+        text = self.__pending + buf
+        self.__pending = ""
+        self.path = self.__stream.path
+        if not len(text):
+            return
+
+        start = self.offset
+        try:
+            yield from self.__parser_text(text)
+        except GeneratorExit:
+            # 调用方中途不取了, 没处理的内容留到下一次继续
+            if self.__state != JsonStreamState.DONE:
+                self.__pending = text[self.offset - start :]
+            raise
+        except Exception as e:
+            if self.__state != JsonStreamState.ERROR:
+                self.__state = JsonStreamState.ERROR
+                self.error = f"fail to parser json: {e}"
+            raise Exception(self.error)
+        finally:
+            self.base = self.offset
+
+    def __parser_text(self, text: str) -> Generator[JsonStreamData, None, None]:
+        State = JsonStreamState
+        base = self.offset
+        pos = 0
+        end = len(text)
+
+        while pos < end:
+            state = self.__state
+            stream = self.__stream
+
+            if state == State.STR:
+                match = self.__str_special.search(text, pos)
+                if not match:
+                    self.__emit(text[pos:])
+                    pos = end
+                    break
+                stop = match.start()
+                if stop > pos:
+                    self.__emit(text[pos:stop])
+                pos = stop + 1
+                if text[stop] == "\\":
+                    self.__state = State.STR_ESC
                     continue
 
-                if self.need_skip_char(self.buf[self.offset]):
-                    self.offset += 1
+                # 字符串结束
+                if self.__high_surrogate:
+                    self.__emit("")
+                if self.__in_key:
+                    self.__in_key = False
+                    self.__key = "".join(self.__key_parts)
+                    self.__state = State.OBJ_COLON
                     continue
-
-                log_dbg(
-                    f"({self.path}) ({obj_stream.path}) {obj_stream.type} obj_stream[{obj_stream.now_key}] = {self.buf[self.offset:]}...?"
-                )
-                log_dbg(f"self.offset: {self.offset}, buf_len: {len(self.buf)}, ")
-
-                for sub_stream in self.parser_buf(stream):
-                    sub_stream: JsonStreamData
-
-                    if not sub_stream:
-                        continue
-
-                    if sub_stream.parent != obj_stream:
-                        yield sub_stream
-                        break
-
-                    log_dbg(
-                        f"send type: {sub_stream.type}, data: {str(sub_stream.data)}, done: {str(sub_stream.done)}"
-                    )
-
-                    yield sub_stream
-
-                    if sub_stream.done:
-                        break
-
-        yield obj_stream
-
-    def get_now_parser_arr_stream(self, arr_stream: JsonStreamData) -> JsonStreamData:
-        now_path = f"{self.path}[{arr_stream.now_arr_cnt}]"
-        stream = self.get_stream(now_path)
-        arr_data: List[JsonStreamData] = arr_stream.stream_data
-
-        if len(arr_data) < arr_stream.now_arr_cnt + 1:
-            stream.parent = arr_stream
-            self.path = now_path
-            arr_data.append(stream)
-
-        return stream
-
-    def parser_arr(self, arr_stream: JsonStreamData):
-        if arr_stream.type == JsonStreamDataType.ARR:
-            cur = len(self.buf) - self.offset
-
-            now_stream = self.get_now_parser_arr_stream(arr_stream)
-
-            while cur and self.offset < len(self.buf):
-                cur -= 1
-
-                log_dbg(f"cur: {cur}, offset: {self.offset}, all: {len(self.buf)}")
-
-                if self.need_skip_char(self.buf[self.offset]):
-                    self.offset += 1
+                stream.chunk = "".join(self.__chunk_parts)
+                self.__chunk_parts = []
+                self.offset = base + pos
+                self.__finish(stream)
+                yield stream
+                self.path = self.__stream.path
+                continue
+
+            if state == State.STR_ESC:
+                ch = text[pos]
+                pos += 1
+                if ch == "u":
+                    self.__unicode = ""
+                    self.__state = State.STR_UNICODE
+                else:
+                    self.__emit(JSON_STREAM_ESCAPE.get(ch, ch))
+                    self.__state = State.STR
+                continue
+
+            if state == State.STR_UNICODE:
+                need = 4 - len(self.__unicode)
+                self.__unicode += text[pos : pos + need]
+                pos += need
+                if len(self.__unicode) < 4:
                     continue
-
-                # 还没开始拿到元素就结束数组了
-                if self.buf[self.offset] == "]":
-                    arr_stream.done = True
-                    self.offset += 1
-                    log_dbg(
-                        f"self.path: {self.path}, arr_dream.path: {arr_stream.path}, "
-                        f"arr_strem done. {arr_stream}"
-                    )
+                self.__emit_unicode(int(self.__unicode, 16))
+                self.__state = State.STR
+                continue
+
+            if state == State.LITERAL:
+                match = self.__literal.match(text, pos)
+                self.__literal_parts.append(match.group())
+                pos = match.end()
+                if pos >= end:
                     break
 
-                # 出现新下标就创建新的继续解析
-                if self.buf[self.offset] == ",":
-                    arr_stream.now_arr_cnt += 1
-                    self.offset += 1
-                    now_stream = self.get_now_parser_arr_stream(arr_stream)
-
-                    continue
-
-                for item_stream in self.parser_buf(now_stream):
-                    item_stream: JsonStreamData
-
-                    if not item_stream:
-                        continue
-
-                    if item_stream.parent != arr_stream:
-                        yield item_stream
-                        break
-
-                    log_dbg(
-                        f"({self.path}): item type: {item_stream.type}, ({item_stream.path}) item_data: {item_stream.str()}"
-                    )
-
-                    yield item_stream
-
-                    if item_stream.done:
-                        break
-
-        yield arr_stream
-
-    def parser_num(self, num_stream: JsonStreamData):
-        if num_stream.type == JsonStreamDataType.NUM:
-            if not num_stream.val_start:
-                num_stream.val_start = self.offset
-            cur = len(self.buf) - self.offset
-            log_dbg(
-                f"offset: {self.offset}, all: {len(self.buf)}, buf: {self.buf[self.offset:]}"
-            )
-
-            while cur and self.offset < len(self.buf):
-                cur -= 1
-                ch = self.buf[self.offset]
-                if ch == "," or ch == "]" or ch == "}":
-                    num_stream.val_end = self.offset
-                    num = self.buf[num_stream.val_start : num_stream.val_end]
-                    log_dbg(
-                        f"num: {str(num)}, offset: {self.offset}, all: {len(self.buf)}, buf: {self.buf[self.offset:]}"
-                    )
-                    num_stream.set_data(int(num))
-
-                    num_stream.chunk = num_stream.data
-                    num_stream.done = True
-
-                    break
-
-                self.offset += 1
-
-        yield num_stream
-
-    def parser_nul(self, nul_stream: JsonStreamData):
-        if nul_stream.type == JsonStreamDataType.NUL:
-            if not nul_stream.val_start:
-                nul_stream.val_start = self.offset
-            cur = len(self.buf) - self.offset
-
-            while cur and self.offset < len(self.buf):
-                cur -= 1
-
-                ch = self.buf[self.offset]
-                if ch == "," or ch == "]" or ch == "}":
-                    nul_stream.val_end = self.offset
-                    nul = self.buf[nul_stream.val_start : nul_stream.val_end]
-                    if "null" != nul:
-                        raise Exception(f"data not null: {self.buf}")
-                    nul_stream.set_data(None)
-
-                    nul_stream.chunk = nul_stream.data
-
-                    nul_stream.done = True
-
+                # 遇到分隔符, 分隔符留给外层处理
+                stream.set_data(self.__literal_value(stream, "".join(self.__literal_parts)))
+                self.__literal_parts = []
+                stream.chunk = stream.data
+                self.offset = base + pos
+                self.__finish(stream)
+                yield stream
+                self.path = self.__stream.path
+                continue
+
+            if state == State.SKIP or state == State.SKIP_STR:
+                if state == State.SKIP:
+                    match = self.__skip_special.search(text, pos)
+                else:
+                    match = self.__str_special.search(text, pos)
+                if not match:
+                    pos = end
                     break
-
-                self.offset += 1
-
-        yield nul_stream
-
-    def parser_bol(self, bol_stream: JsonStreamData):
-        if bol_stream.type == JsonStreamDataType.BOL:
-            if not bol_stream.val_start:
-                bol_stream.val_start = self.offset
-            end = 0
-            cur = len(self.buf) - self.offset
-
-            while cur and self.offset < len(self.buf):
-                cur += 1
-
-                ch = self.buf[self.offset]
-                if ch == "," or ch == "]" or ch == "}":
-                    bol_stream.val_end = self.offset
-                    bol = self.buf[bol_stream.val_start : bol_stream.val_end]
-
-                    if bol == "true":
-                        bol_stream.set_data(True)
+                pos = match.end()
+                ch = match.group()
+                if ch == "\\":
+                    self.__state = State.SKIP_ESC
+                elif ch == '"':
+                    if state == State.SKIP:
+                        self.__state = State.SKIP_STR
+                    elif self.__skip_depth:
+                        self.__state = State.SKIP
                     else:
-                        bol_stream.set_data(False)
-                    bol_stream.chunk = bol_stream.data
-                    bol_stream.done = True
-
-                    break
-
-                self.offset += 1
-
-        yield bol_stream
-
-    def parser_str(self, str_stream: JsonStreamData):
-        if str_stream.type == JsonStreamDataType.STR:
-            cur = len(self.buf) - self.offset
-
-            str_stream.chunk = ""
-
-            while cur and self.offset < len(self.buf):
-                cur -= 1
-
-                log_dbg(
-                    f"({self.path}) ({str_stream.path}) {str_stream.type} parser str. "
-                    f"offset: {self.offset}, val: {self.buf[self.offset:]}"
-                )
-
-                if self.buf[self.offset] == '"' and (
-                    self.is_real_ch(self.buf, self.offset)
+                        self.__skip_done()
+                elif ch == "[" or ch == "{":
+                    self.__skip_depth += 1
+                else:
+                    self.__skip_depth -= 1
+                    if not self.__skip_depth:
+                        self.__skip_done()
+                continue
+
+            if state == State.SKIP_ESC:
+                pos += 1
+                self.__state = State.SKIP_STR
+                continue
+
+            if state == State.SKIP_LITERAL:
+                pos = self.__literal.match(text, pos).end()
+                if pos < end:
+                    self.__skip_done()
+                continue
+
+            if state == State.DONE:
+                # 根节点结束之后的内容不处理
+                break
+
+            pos = self.__space.match(text, pos).end()
+            if pos >= end:
+                break
+            ch = text[pos]
+
+            if state == State.VALUE:
+                type = JSON_STREAM_PARSER_TYPE.get(ch)
+                if not type:
+                    raise Exception(f"unexpected char {repr(ch)} of value at {base + pos}")
+                if (
+                    stream.watch is not None
+                    and stream is not self.root_stream
+                    and type != JsonStreamDataType.OBJ
+                    and type != JsonStreamDataType.ARR
                 ):
-                    self.offset += 1
-                    str_stream.done = True
-                    log_dbg(
-                        f"({self.path}) ({str_stream.path}) {str_stream.type} stream parser done: {str_stream.data}"
-                    )
-                    break
-
-                real_ch = self.buf[self.offset]
-
-                if "\\" == real_ch and self.is_real_ch(self.buf, self.offset):
-                    print(f"skip escape ch: {real_ch}")
-                    self.offset += 1
+                    # 订阅路径还没走完就遇到标量, 不可能匹配了
+                    self.__drop(stream)
+                    self.__state = State.SKIP_VALUE
                     continue
+                stream.reset(type)
+                if type == JsonStreamDataType.OBJ:
+                    pos += 1
+                    self.__state = State.OBJ_KEY
+                elif type == JsonStreamDataType.ARR:
+                    pos += 1
+                    self.__state = State.ARR_ITEM
+                elif type == JsonStreamDataType.STR:
+                    pos += 1
+                    self.__chunk_parts = []
+                    self.__state = State.STR
+                else:
+                    self.__literal_parts = []
+                    self.__state = State.LITERAL
+
+            elif state == State.SKIP_VALUE:
+                type = JSON_STREAM_PARSER_TYPE.get(ch)
+                if not type:
+                    raise Exception(f"unexpected char {repr(ch)} of value at {base + pos}")
+                if type == JsonStreamDataType.OBJ or type == JsonStreamDataType.ARR:
+                    pos += 1
+                    self.__skip_depth = 1
+                    self.__state = State.SKIP
+                elif type == JsonStreamDataType.STR:
+                    pos += 1
+                    self.__skip_depth = 0
+                    self.__state = State.SKIP_STR
+                else:
+                    self.__state = State.SKIP_LITERAL
+
+            elif state == State.OBJ_KEY or state == State.OBJ_NEXT:
+                if ch == "}":
+                    pos += 1
+                    self.offset = base + pos
+                    self.__finish(stream)
+                    if stream.watch is None:
+                        yield stream
+                    self.path = self.__stream.path
+                elif state == State.OBJ_NEXT and ch == ",":
+                    pos += 1
+                    self.__state = State.OBJ_KEY
+                elif state == State.OBJ_KEY and ch == '"':
+                    pos += 1
+                    self.__in_key = True
+                    self.__key_parts = []
+                    self.__state = State.STR
+                else:
+                    raise Exception(f"unexpected char {repr(ch)} in object at {base + pos}")
+
+            elif state == State.OBJ_COLON:
+                if ch != ":":
+                    raise Exception(f"unexpected char {repr(ch)} after key at {base + pos}")
+                pos += 1
+                self.__push(stream, self.__key)
+
+            elif state == State.ARR_ITEM or state == State.ARR_NEXT:
+                if ch == "]":
+                    pos += 1
+                    self.offset = base + pos
+                    self.__finish(stream)
+                    if stream.watch is None:
+                        yield stream
+                    self.path = self.__stream.path
+                elif state == State.ARR_NEXT:
+                    if ch != ",":
+                        raise Exception(f"unexpected char {repr(ch)} in array at {base + pos}")
+                    pos += 1
+                    stream.now_arr_cnt += 1
+                    self.__state = State.ARR_ITEM
+                else:
+                    self.__push(stream, stream.now_arr_cnt)
 
-                if not self.is_real_ch(self.buf, self.offset):
-                    escape = {
-                        "\\": "\\",
-                        '"': '"',
-                        "/": "/",
-                        "b": "\b",
-                        "f": "\f",
-                        "n": "\n",
-                        "r": "\r",
-                        "t": "\t",
-                    }
-                    real_ch = escape.get(real_ch)
-                    if not real_ch:
-                        real_ch = self.buf[self.offset]
-                    else:
-                        print(f"pack real_ch to [{real_ch}]")
-
-                new_data = str_stream.stream_data + real_ch
-                str_stream.set_data(new_data)
+        self.offset = base + pos
 
-                str_stream.chunk += real_ch
+        # 还没解析完的标量也上报一次, 让调用方拿到这次新增的内容
+        stream = self.__stream
+        if not stream.done and stream.type in (
+            JsonStreamDataType.STR,
+            JsonStreamDataType.NUM,
+            JsonStreamDataType.BOL,
+            JsonStreamDataType.NUL,
+        ):
+            if stream.type == JsonStreamDataType.STR:
+                stream.chunk = "".join(self.__chunk_parts)
+                self.__chunk_parts = []
+            self.path = stream.path
+            yield stream
+
+    def __emit(self, text: str):
+        if self.__high_surrogate:
+            text = chr(self.__high_surrogate) + text
+            self.__high_surrogate = 0
+        if self.__in_key:
+            self.__key_parts.append(text)
+        elif text:
+            self.__stream.append_str(text)
+            self.__chunk_parts.append(text)
+
+    def __emit_unicode(self, code: int):
+        if 0xDC00 <= code < 0xE000 and self.__high_surrogate:
+            code = 0x10000 + ((self.__high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self.__high_surrogate = 0
+            self.__emit(chr(code))
+        elif 0xD800 <= code < 0xDC00:
+            # 代理对的前半, 等下一个 \uXXXX 再合起来
+            if self.__high_surrogate:
+                self.__emit("")
+            self.__high_surrogate = code
+        else:
+            self.__emit(chr(code))
+
+    def __literal_value(self, stream: JsonStreamData, literal: str):
+        if stream.type == JsonStreamDataType.NUM:
+            if self.__int.fullmatch(literal):
+                return int(literal)
+            try:
+                return float(literal)
+            except ValueError:
+                raise Exception(f"data not num: {literal}")
+        if stream.type == JsonStreamDataType.BOL:
+            if literal == "true":
+                return True
+            if literal == "false":
+                return False
+            raise Exception(f"data not bool: {literal}")
+        if literal != "null":
+            raise Exception(f"data not null: {literal}")
+        return None
+
+    def __push(self, parent: JsonStreamData, key: Union[str, int]):
+        watch = self.__child_watch(parent, key)
+        if watch == ():
+            self.__state = JsonStreamState.SKIP_VALUE
+            return
+
+        if parent.type == JsonStreamDataType.OBJ:
+            path = f'{parent.path}["{key}"]'
+        else:
+            path = f"{parent.path}[{key}]"
+        stream = JsonStreamData(JsonStreamDataType.UND, path)
+        stream.parent = parent
+        stream.watch = watch
+        if parent.type == JsonStreamDataType.OBJ:
+            parent.now_key = key
+        parent.add_child(key, stream)
+        self.stream_map[path] = stream
+
+        self.__stream = stream
+        self.path = path
+        self.__state = JsonStreamState.VALUE
 
-                self.offset += 1
+    def __child_watch(self, parent: JsonStreamData, key: Union[str, int]) -> Optional[tuple]:
+        # None: 整棵子树都订阅了; (): 跳过; 其他: 还在匹配中的 (模式, 层)
+        if parent.watch is None:
+            return None
+        watch = []
+        for idx, depth in parent.watch:
+            segments = self.__patterns[idx]
+            segment = segments[depth]
+            if segment is None:
+                pass
+            elif isinstance(segment, int):
+                if segment != key or isinstance(key, str):
+                    continue
+            elif isinstance(key, int) or not fnmatch.fnmatchcase(key, segment):
+                continue
+            if depth + 1 == len(segments):
+                return None
+            watch.append((idx, depth + 1))
+        return tuple(watch)
+
+    def __drop(self, stream: JsonStreamData):
+        # 把已经挂上去的节点摘掉, 当成没订阅的值跳过
+        parent = stream.parent
+        parent.remove_child(stream)
+        self.stream_map.pop(stream.path, None)
+        self.__stream = parent
+        self.path = parent.path
+
+    def __skip_done(self):
+        self.skipped += 1
+        if self.__stream.type == JsonStreamDataType.OBJ:
+            self.__stream.type_parser_reset()
+            self.__state = JsonStreamState.OBJ_NEXT
+        else:
+            self.__state = JsonStreamState.ARR_NEXT
+
+    def __finish(self, stream: JsonStreamData):
+        # 当前值解析完成, 先切回父节点的状态再上报,
+        # 这样调用方在上报的时候停下不取了, 下次也能接着解析.
+        stream.done = True
+        self.path = stream.path
+        if stream is self.root_stream:
+            self.done = True
+            self.__state = JsonStreamState.DONE
+            return
+
+        parent = stream.parent
+        parent.child_done(stream)
+        if parent.type == JsonStreamDataType.OBJ:
+            parent.type_parser_reset()
+            self.__state = JsonStreamState.OBJ_NEXT
+        else:
+            self.__state = JsonStreamState.ARR_NEXT
+        self.__stream = parent
+
+
+def benchmark_stream(
+    size: int = 100 * 1024,
+    chunk_min: int = 1,
+    chunk_max: int = 64,
+    seed: int = 0,
+    subscribe: Optional[List[str]] = None,
+    read_data: bool = False,
+    encode: bool = False,
+    baseline: str = "",
+):
+    """
+    把大约 size 字节的模型回复随机切成 chunk_min ~ chunk_max 字节的块, 测整份解析的耗时.
+    baseline 是 git 版本号 (如 HEAD~1) 时, 从这个版本取出 tool/json_stream.py 跑同样的输入, 用来对比.
+    (旧版不支持小数, 数据里只有整数)
+    """
+    import io
+    import json
+    import time
+    import random
+    import contextlib
+
+    if baseline and (subscribe or encode):
+        raise Exception("baseline parser not support subscribe / bytes input")
+
+    rng = random.Random(seed)
+    actions = []
+    while len(json.dumps(actions, ensure_ascii=False)) < size:
+        actions.append(
+            {
+                "type": "object",
+                "timestamp": len(actions) + 1,
+                "expect": "回答问题",
+                "reasoning": "思考: " + "推理过程 reasoning \\ \"quote\" " * rng.randint(5, 30),
+                "call": "chat_to_master",
+                "request": {
+                    "type": "object",
+                    "content": "```python\nprint('hello')\n```\n" * rng.randint(5, 40),
+                    "from": [rng.randint(0, 100), 15],
+                },
+                "conclusion": "完成. 😀",
+                "execute": "system",
+            }
+        )
+    text = json.dumps(actions, ensure_ascii=rng.random() < 0.5, indent=4)
+
+    # encode: 按字节切块, 多字节字符会被切开
+    data = text.encode("utf-8") if encode else text
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        step = rng.randint(chunk_min, chunk_max)
+        chunks.append(data[pos : pos + step])
+        pos += step
+
+    if baseline:
+        jss = load_baseline_stream(baseline)()
+    else:
+        jss = JsonStream(subscribe)
+    cnt = 0
+    # 旧版遇到转义字符会 print, 丢掉
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.time()
+        for chunk in chunks:
+            for _ in jss.parser(chunk):
+                cnt += 1
+                if read_data:
+                    # 模拟调用方每次都读整棵树
+                    jss.root_stream.len()
+                    jss.data
+        cost = time.time() - start
+
+    if encode:
+        check = f"bytes input, same as json.loads: {jss.done and jss.data == json.loads(text)}"
+    elif read_data:
+        check = f"read data every stream, same as json.loads: {jss.data == json.loads(text)}"
+    elif subscribe:
+        check = f"subscribe {len(subscribe)} paths, {len(jss.stream_map)} nodes, {jss.skipped} skipped"
+    else:
+        check = f"same as json.loads: {jss.done and jss.data == json.loads(text)}"
+    print(
+        f"json stream{f' ({baseline})' if baseline else ''}: {len(text) / 1024:.0f} KB, {len(chunks)} chunks ({chunk_min}-{chunk_max}), "
+        f"{cnt} streams, {cost * 1000:.1f} ms, {len(text) / cost / 1024 / 1024:.2f} MB/s, {check}"
+    )
+    return cost
 
-        yield str_stream
 
-    def is_real_ch(self, buf, now_offset):
-        now = buf[now_offset]
-        log_dbg(f"check end: {now}")
+def load_baseline_stream(rev: str):
+    """
+    从 git 版本 rev 里取出 tool/json_stream.py, 返回它的 JsonStream, 只给 benchmark 对比用.
+    """
+    import os
+    import types
+    import subprocess
 
-        if now_offset < 1:  # 至少要有两个字符
-            return False
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    source = subprocess.check_output(
+        ["git", "show", f"{rev}:tool/json_stream.py"], cwd=root
+    ).decode("utf-8")
+    module = types.ModuleType(f"json_stream_{rev}")
+    exec(compile(source, f"{rev}:tool/json_stream.py", "exec"), module.__dict__)
+    return module.JsonStream
 
-        if buf[now_offset - 1] != "\\":  # 前面不是 \ , 这里收到了 " 说明 json val 结束
-            return True
-        if now_offset < 2:
-            return True
 
-        if buf[now_offset - 2] != "\\":  # ?\" continue
-            return False
-        if now_offset < 3:
-            return False
+def benchmark_memory(size: int = 8 * 1024 * 1024, chunk: int = 64):
+    """
+    边生成边喂一份 size 字节的长回复, 只订阅 call, 看解析过程中的峰值内存.
+    """
+    import json
+    import tracemalloc
 
-        if buf[now_offset - 3] != "\\":  # ? \\ " end
-            return True
-        if now_offset < 4:
-            return True
+    item = json.dumps(
+        {
+            "type": "object",
+            "call": "chat_to_master",
+            "request": {"type": "object", "content": "长内容 long content " * 200},
+        },
+        ensure_ascii=False,
+    )
 
-        if buf[now_offset - 4] != "\\":  # ? \\ \" continue
-            return False
+    jss = JsonStream(['json[*]["call"]'])
+    tracemalloc.start()
+    fed = 0
+    for _ in jss.parser("["):
+        pass
+    while fed < size:
+        text = ("," if fed else "") + item
+        for pos in range(0, len(text), chunk):
+            for _ in jss.parser(text[pos : pos + chunk]):
+                pass
+        fed += len(text)
+    for _ in jss.parser("]"):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
 
-        # \\ \\ " end
-        return True
+    print(
+        f"json stream memory: {fed / 1024 / 1024:.1f} MB input, {len(jss.root_stream.stream_data)} items, "
+        f"peak {peak / 1024 / 1024:.2f} MB, buf {len(jss.buf)}, done: {jss.done}"
+    )
+    return peak
 
 
 if __name__ == "__main__":
@@ -787,3 +994,22 @@ if __name__ == "__main__":
 
     # root = json_stream.stream_map['json.arr[0]']
     # print(f"jss: {root.str()}")
+
+    import sys
+
+    # python -m tool.json_stream <git 版本号>: 和这个版本的解析器对比
+    baseline = sys.argv[1] if len(sys.argv) > 1 else ""
+    for chunk_min, chunk_max in [(1, 1), (1, 8), (1, 64)]:
+        if baseline:
+            benchmark_stream(chunk_min=chunk_min, chunk_max=chunk_max, baseline=baseline)
+        benchmark_stream(chunk_min=chunk_min, chunk_max=chunk_max)
+        benchmark_stream(
+            chunk_min=chunk_min,
+            chunk_max=chunk_max,
+            subscribe=['json[*]["call"]', 'json[*]["request"]["content"]'],
+        )
+    benchmark_stream(read_data=True)
+    benchmark_stream(chunk_min=1, chunk_max=1, encode=True)
+    benchmark_stream(encode=True)
+
+    benchmark_memory()
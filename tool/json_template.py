@@ -0,0 +1,42 @@
+import re
+import json
+from typing import Any, Dict, List
+
+
+class JsonTemplate:
+    """
+    带占位符的对象只序列化一次, 之后每次只把动态字段拼进去.
+    value(name): 整个字段值是动态的, render 时传入已经序列化好的 JSON.
+    text(name): 字符串里的一段是动态的, render 时传入可以直接放进 JSON 字符串里的文本.
+    """
+
+    __pattern = re.compile(r'"@@aimi_value:(\w+)@@"|@@aimi_text:(\w+)@@')
+
+    parts: List[str]
+    keys: List[str]
+
+    @staticmethod
+    def value(name: str) -> str:
+        return f"@@aimi_value:{name}@@"
+
+    @staticmethod
+    def text(name: str) -> str:
+        return f"@@aimi_text:{name}@@"
+
+    def __init__(self, obj: Any):
+        js = json.dumps(obj, ensure_ascii=False)
+        self.parts = []
+        self.keys = []
+        pos = 0
+        for match in self.__pattern.finditer(js):
+            self.parts.append(js[pos : match.start()])
+            self.keys.append(match.group(1) or match.group(2))
+            pos = match.end()
+        self.parts.append(js[pos:])
+
+    def render(self, values: Dict[str, str]) -> str:
+        out = [self.parts[0]]
+        for key, part in zip(self.keys, self.parts[1:]):
+            out.append(values[key])
+            out.append(part)
+        return "".join(out)
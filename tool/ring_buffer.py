@@ -0,0 +1,116 @@
+from typing import Any, Generator, List, Optional, Tuple
+
+
+class TalkItem:
+    """
+    一条问答记忆. 用 __slots__ 代替 dict, 每条省掉一个字典的开销.
+    同时支持 item["q"] / item.get("q") 这样的字典式访问, 召回模型不用改.
+    """
+
+    __slots__ = ("q", "a", "idx")
+
+    def __init__(self, q: str, a: str, idx: int = 0):
+        self.q = q
+        self.a = a
+        self.idx = idx
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+    def to_dict(self) -> dict:
+        return {"q": self.q, "a": self.a, "idx": self.idx}
+
+    def __repr__(self) -> str:
+        return str(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, item: Optional[dict]) -> Optional["TalkItem"]:
+        if not item:
+            return None
+        try:
+            return cls(item["q"], item["a"], item.get("idx", 0))
+        except Exception:
+            return None
+
+
+class TalkRing:
+    """
+    固定容量的环形记忆. head 是下一次写入的槽位, count 是实际占用的槽位数.
+    按槽位下标访问时和原来的 pool 列表一样: len() 是容量, 空槽位是 None.
+    """
+
+    size: int
+    head: int = 0
+    count: int = 0
+    items: List[Optional[TalkItem]]
+
+    def __init__(self, size: int):
+        self.size = size
+        self.head = 0
+        self.count = 0
+        self.items = [None] * size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, slot):
+        return self.items[slot]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def put(self, slot: int, item: Optional[TalkItem]):
+        old = self.items[slot]
+        if old is None and item is not None:
+            self.count += 1
+        elif old is not None and item is None:
+            self.count -= 1
+        self.items[slot] = item
+
+    def append(self, item: TalkItem) -> int:
+        slot = self.head
+        self.put(slot, item)
+        self.head = self.next_slot(slot)
+        return slot
+
+    def next_slot(self, slot: int) -> int:
+        return slot + 1 if slot < self.size - 1 else 0
+
+    def newest(self) -> Generator[Tuple[int, TalkItem], None, None]:
+        # 从最新往最旧遍历, 不复制
+        items = self.items
+        for slot in range(self.head - 1, -1, -1):
+            if items[slot] is not None:
+                yield slot, items[slot]
+        for slot in range(self.size - 1, self.head - 1, -1):
+            if items[slot] is not None:
+                yield slot, items[slot]
+
+    def fix_head(self) -> int:
+        # 最新的一条一定在 head 前面, 对得上就相信保存的 head (中间可能有清空的槽位);
+        # 对不上时按没写满处理, head 紧跟在最后一条记忆后面.
+        if self.count and self.items[self.head - 1] is not None:
+            return self.head
+        if self.count < self.size:
+            slot = self.size
+            while slot > 0 and self.items[slot - 1] is None:
+                slot -= 1
+            self.head = slot if slot < self.size else 0
+        return self.head
+
+    def to_list(self) -> List[Optional[dict]]:
+        return [item.to_dict() if item is not None else None for item in self.items]
+
+    @classmethod
+    def from_list(cls, pool: List[Optional[dict]], size: int, head: int = 0) -> "TalkRing":
+        ring = cls(size)
+        for slot, item in enumerate(pool[:size]):
+            ring.put(slot, TalkItem.from_dict(item))
+        ring.head = head if 0 <= head < size else 0
+        return ring
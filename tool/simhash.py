@@ -0,0 +1,106 @@
+import re
+import hashlib
+import numpy as np
+from typing import Dict, List, Set
+
+SIMHASH_BITS = 64
+
+
+def simhash(text: str, ngram: int = 2) -> int:
+    """
+    64 位 SimHash: 把字符 n-gram 的哈希按位投票, 相似文本的签名只差几位.
+    """
+    # 忽略大小写, 空白和标点
+    text = re.sub(r"[\W_]+", "", text.lower())
+    if not text:
+        return 0
+
+    if len(text) <= ngram:
+        grams = [text]
+    else:
+        grams = [text[i : i + ngram] for i in range(len(text) - ngram + 1)]
+
+    hashes = np.frombuffer(
+        b"".join(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest() for g in grams),
+        dtype="<u8",
+    )
+    # 每一位上 1 的票数过半就置 1
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = bits.sum(axis=0) * 2 > len(grams)
+    return int.from_bytes(np.packbits(votes, bitorder="little").tobytes(), "little")
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    """
+    按槽位保存 SimHash 签名, 64 位切成 bands 段分别建桶.
+    海明距离小于 bands 的两个签名至少有一段完全相同, 所以查找只需要看 bands 个桶, 增删都是 O(1).
+    """
+
+    bands: int = 4
+    distance: int = 3
+
+    def __init__(self, size: int, distance: int = 3):
+        self.distance = distance
+        self.bands = distance + 1
+        self.band_bits = SIMHASH_BITS // self.bands
+        self.band_mask = (1 << self.band_bits) - 1
+        self.sigs: List[int] = [-1] * size
+        self.buckets: List[Dict[int, Set[int]]] = [{} for _ in range(self.bands)]
+
+    def __band_keys(self, sig: int):
+        for band in range(self.bands):
+            yield band, (sig >> (band * self.band_bits)) & self.band_mask
+
+    def add(self, slot: int, sig: int):
+        self.remove(slot)
+        self.sigs[slot] = sig
+        for band, key in self.__band_keys(sig):
+            self.buckets[band].setdefault(key, set()).add(slot)
+
+    def remove(self, slot: int):
+        sig = self.sigs[slot]
+        if sig < 0:
+            return
+        self.sigs[slot] = -1
+        for band, key in self.__band_keys(sig):
+            bucket = self.buckets[band].get(key)
+            if bucket is None:
+                continue
+            bucket.discard(slot)
+            if not bucket:
+                del self.buckets[band][key]
+
+    def find(self, sig: int) -> int:
+        # 返回距离最近的近似重复槽位, 没有返回 -1
+        best_slot, best_dist = -1, self.distance + 1
+        for band, key in self.__band_keys(sig):
+            for slot in self.buckets[band].get(key, ()):
+                dist = hamming(sig, self.sigs[slot])
+                if dist < best_dist:
+                    best_slot, best_dist = slot, dist
+        return best_slot
+
+
+if __name__ == "__main__":
+    import time
+
+    a = simhash("Master 摸摸头, 今天天气真好\n*蹭蹭* “好的”")
+    b = simhash("Master 摸摸头, 今天天气真好!\n*蹭蹭* “好的”")
+    c = simhash("帮我写一个快速排序\n好的, 下面是代码")
+    print(f"near: {hamming(a, b)}, far: {hamming(a, c)}")
+
+    size = 10000
+    index = SimHashIndex(size)
+    texts = [f"第{i}条记忆, 随便说点什么 {i * 7919 % 1000}" for i in range(size)]
+    start = time.time()
+    sigs = [simhash(t) for t in texts]
+    print(f"simhash: {(time.time() - start) / size * 1e6:.1f} us/item")
+    start = time.time()
+    for slot, sig in enumerate(sigs):
+        index.find(sig)
+        index.add(slot, sig)
+    print(f"find + add: {(time.time() - start) / size * 1e6:.1f} us/item")
@@ -0,0 +1,54 @@
+import math
+from functools import lru_cache
+from typing import Any
+
+from tool.util import log_dbg
+
+# 每条 chat message 在上游除了内容本身还会额外占用的 token
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+@lru_cache(maxsize=32)
+def get_encoding(model: str = "") -> Any:
+    try:
+        import tiktoken
+    except Exception:
+        return None
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        pass
+
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        log_dbg(f"no tiktoken encoding: {e}")
+        return None
+
+
+def encoding_name(model: str = "") -> str:
+    encoding = get_encoding(model)
+    if not encoding:
+        return "estimate"
+    return encoding.name
+
+
+def estimate_tokens(text: str) -> int:
+    # 没有 tiktoken 时的估算: 中日韩字符大约各占一个 token, 其他字符大约 4 个一个 token.
+    cjk = 0
+    for ch in text:
+        if ch >= "⺀":
+            cjk += 1
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    if not text:
+        return 0
+
+    encoding = get_encoding(model)
+    if not encoding:
+        return estimate_tokens(text)
+
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,230 @@
+import os
+import time
+import random
+import threading
+import multiprocessing
+from typing import Any, Callable, Dict, List, Set
+
+from tool.util import log_dbg, log_err, log_info
+
+
+class TrainScheduler:
+    """
+    记忆模型训练调度: 新记忆攒够 train_every 条, 或者距离上次训练超过 train_interval_s 时,
+    在独立进程里基于上一次的权重做增量训练, 训练完成后原子替换权重文件并热切换到预测模型上.
+    """
+
+    model: Any
+    model_file: str
+    train_every: int = 32
+    train_interval_s: int = 3600
+    train_retry_s: int = 30
+    train_max: int = 512
+    depth: int = 20
+    epochs: int = 5
+    batch_size: int = 16
+    running: bool = False
+    last_stats: Dict = {}
+
+    def __init__(
+        self,
+        model: Any,
+        get_pool: Callable[[], List[dict]],
+        model_file: str,
+        setting: Dict = None,
+    ):
+        if setting is None:
+            setting = {}
+        self.model = model
+        self.get_pool = get_pool
+        self.model_file = model_file
+        self.last_stats = {}
+        self.__dirty: Set[int] = set()
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__last_train = 0
+        self.__fail_count = 0
+        self.__retry_at = 0
+
+        try:
+            self.train_every = int(setting["memory_train_every"])
+        except:
+            self.train_every = 32
+        try:
+            self.train_interval_s = int(setting["memory_train_interval_s"])
+        except:
+            self.train_interval_s = 3600
+        try:
+            self.train_retry_s = int(setting["memory_train_retry_s"])
+        except:
+            self.train_retry_s = 30
+        try:
+            self.train_max = int(setting["memory_train_max"])
+        except:
+            self.train_max = 512
+        try:
+            self.depth = int(setting["memory_model_depth"])
+        except:
+            self.depth = 20
+        try:
+            self.batch_size = int(setting["memory_train_batch_size"])
+        except:
+            self.batch_size = 16
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+
+        pool = self.get_pool()
+        if os.path.exists(self.model_file):
+            # 有上次的权重就直接用, 不用等训练.
+            try:
+                self.model.load_model(self.model_file, pool)
+                self.__last_train = time.time()
+                log_info(f"load memory model: {self.model_file}")
+            except Exception as e:
+                log_err(f"fail to load memory model: {e}, retrain.")
+                self.__mark_all(pool)
+        else:
+            self.__mark_all(pool)
+
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def notify(self, slot: int):
+        with self.__lock:
+            self.__dirty.add(slot)
+
+    def __restore(self, slots: List[int]):
+        # 训练失败时把这批槽位放回去, 下次继续训练
+        with self.__lock:
+            self.__dirty.update(slots)
+
+    def __mark_all(self, pool: List[dict]):
+        with self.__lock:
+            self.__dirty = {slot for slot, item in enumerate(pool) if item}
+
+    def __need_train(self) -> bool:
+        with self.__lock:
+            dirty = len(self.__dirty)
+        if not dirty:
+            return False
+        if time.time() < self.__retry_at:
+            return False
+        if dirty >= self.train_every or not self.model.enable:
+            return True
+        return time.time() - self.__last_train >= self.train_interval_s
+
+    def __run(self):
+        while self.running:
+            if self.__need_train():
+                try:
+                    self.__train()
+                except Exception as e:
+                    self.__log_fail(f"fail to train memory model: {e}")
+            time.sleep(1)
+
+    def __make_job(self, pool: List[dict]) -> Dict:
+        with self.__lock:
+            dirty = sorted(self.__dirty)
+            self.__dirty = set()
+
+        # 只训练新记忆, 再随机带上一些旧记忆防止遗忘.
+        new_slots = [slot for slot in dirty if slot < len(pool) and pool[slot]]
+        new_slots = new_slots[-self.train_max :]
+        new_set = set(new_slots)
+        old_slots = [slot for slot, item in enumerate(pool) if item and slot not in new_set]
+        replay_slots = random.sample(old_slots, min(len(old_slots), self.depth))
+
+        from tool.transformer import make_train_data
+
+        return {
+            "slots": dirty,
+            "num_labels": len(pool),
+            "train_data": make_train_data(pool, new_slots + replay_slots),
+            "base_file": self.model_file if os.path.exists(self.model_file) else "",
+            "output_file": self.model_file + ".tmp",
+            "epochs": self.epochs,
+            "batch_size": self.batch_size,
+        }
+
+    def __train(self):
+        pool = self.get_pool()
+        job = self.__make_job(pool)
+        if not len(job["train_data"]):
+            return
+
+        done = False
+        try:
+            done = self.__train_job(job, pool)
+        finally:
+            if done:
+                self.__fail_count = 0
+                self.__retry_at = 0
+            else:
+                self.__restore(job["slots"])
+                self.__backoff()
+
+    def __log_fail(self, msg: str):
+        # 连续失败只在第一次报错, 之后的降为调试日志
+        if self.__fail_count:
+            log_dbg(msg)
+        else:
+            log_err(msg)
+
+    def __backoff(self):
+        # 失败后指数退避 (比如离线时加载预训练模型一直失败), 不要每秒都起一个训练进程.
+        self.__fail_count += 1
+        delay = min(self.train_interval_s, self.train_retry_s * 2 ** min(self.__fail_count - 1, 16))
+        self.__retry_at = time.time() + delay
+        if self.__fail_count == 1:
+            log_err(f"train memory model failed, retry after {delay}s with backoff")
+        else:
+            log_dbg(f"train memory model failed {self.__fail_count} times, retry after {delay}s")
+
+    def __train_job(self, job: Dict, pool: List[dict]) -> bool:
+        log_info(f"start train memory model: {len(job['train_data'])} samples")
+
+        ctx = multiprocessing.get_context("spawn")
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+
+        from tool.transformer import train_process
+
+        proc = ctx.Process(target=train_process, args=(job, send_conn))
+        proc.daemon = True
+        proc.start()
+        send_conn.close()
+
+        stats = {}
+        while self.running and proc.is_alive() and not recv_conn.poll(1):
+            pass
+        try:
+            if recv_conn.poll():
+                stats = recv_conn.recv()
+        except EOFError:
+            stats = {"error": f"train process exit: {proc.exitcode}"}
+        proc.join(1)
+        recv_conn.close()
+
+        if not stats or "error" in stats:
+            self.__log_fail(f"train memory model failed: {stats.get('error', 'no result')}")
+            return False
+
+        # 原子替换权重文件, 然后热切换模型
+        os.replace(job["output_file"], self.model_file)
+        self.model.load_model(self.model_file, pool)
+        self.__last_train = time.time()
+        self.last_stats = stats
+
+        log_info(
+            f"train memory model done: {stats['samples']} samples x {stats['epochs']} epochs, "
+            f"batch: {stats['batch_size']}, incremental: {stats['incremental']}, duration: {stats['duration']:.2f}s, "
+            f"throughput: {stats['throughput']:.2f} samples/s"
+        )
+        log_dbg(f"train stats: {stats}")
+        return True
@@ -1,41 +1,103 @@
 import os
+import time
+import random
+import queue
+import tempfile
+import threading
+from functools import lru_cache
 import torch
 from torch.utils.data import DataLoader, Dataset
-from transformers import DistilBertTokenizer, DistilBertForSequenceClassification, AdamW
-from typing import Any, List
+from transformers import (
+    DistilBertConfig,
+    DistilBertTokenizer,
+    DistilBertForSequenceClassification,
+    AdamW,
+)
+from typing import Any, Dict, List
 
-from tool.util import log_info
+from tool.util import log_dbg, log_err, log_info
+
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    # from_pretrained 要读词表文件, 整个进程只加载一次.
+    return DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
 
 
 class QAData(Dataset):
+    """
+    构造时一次性把所有问题分词成不补齐的 id 列表, 之后每个 epoch 直接复用.
+    相同的问题在同一份数据里只分词一次.
+    """
+
     def __init__(self, data, tokenizer, max_length=32):
-        self.data = data
+        self.data = [item for item in data if item]
         self.tokenizer = tokenizer
         self.max_length = max_length
 
+        # 缓存跟着数据集走, 训练完就释放
+        token_cache: Dict[str, List[int]] = {}
+        todo = list({item["q"] for item in self.data})
+        if todo:
+            encoding = tokenizer(todo, truncation=True, max_length=max_length)
+            for q, input_ids in zip(todo, encoding["input_ids"]):
+                token_cache[q] = input_ids
+
+        self.input_ids = [token_cache[item["q"]] for item in self.data]
+        self.labels = [item["label"] for item in self.data]
+
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        item = self.data[idx]
-        encoding = self.tokenizer(
-            item["q"],
-            truncation=True,
-            padding="max_length",
-            max_length=self.max_length,
-            return_tensors="pt",
-        )
-        return {
-            "input_ids": encoding["input_ids"].flatten(),
-            "attention_mask": encoding["attention_mask"].flatten(),
-            "labels": torch.tensor(item["label"], dtype=torch.long),
-        }
+        return self.input_ids[idx], self.labels[idx]
+
+
+class BucketSampler:
+    """
+    按长度排序后切 batch, 同一个 batch 里长度接近, 补齐的 padding 就少.
+    每个 epoch 打乱 batch 的顺序.
+    """
+
+    def __init__(self, lengths: List[int], batch_size: int):
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        self.batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        batches = list(self.batches)
+        random.shuffle(batches)
+        return iter(batches)
+
+
+def collate_batch(batch, pad_id: int = 0):
+    # 动态补齐到 batch 内最长
+    max_len = max(len(input_ids) for input_ids, _ in batch)
+    input_ids = torch.full((len(batch), max_len), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+    for i, (ids, _) in enumerate(batch):
+        input_ids[i, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[i, : len(ids)] = 1
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "labels": torch.tensor([label for _, label in batch], dtype=torch.long),
+    }
 
 
 def train(model, train_data, epochs, batch_size, device):
-    tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
+    tokenizer = get_tokenizer()
     dataset = QAData(train_data, tokenizer)
-    dataloader = DataLoader(dataset, batch_size=batch_size)
+    if not len(dataset):
+        return
+    pad_id = tokenizer.pad_token_id or 0
+    dataloader = DataLoader(
+        dataset,
+        batch_sampler=BucketSampler([len(ids) for ids in dataset.input_ids], batch_size),
+        collate_fn=lambda batch: collate_batch(batch, pad_id),
+    )
 
     optimizer = AdamW(model.parameters(), lr=5e-5)
 
@@ -59,22 +121,119 @@ def train(model, train_data, epochs, batch_size, device):
 
 def export_model(model, file_path):
     torch.save(model.state_dict(), file_path)
+    return True
 
 
-def load_model(file_path):
+def load_model(file_path, num_labels):
     model = DistilBertForSequenceClassification.from_pretrained(
-        "distilbert-base-uncased"
+        "distilbert-base-uncased", num_labels=num_labels
     )
-    model.load_state_dict(torch.load(file_path))
+    model.load_state_dict(torch.load(file_path, map_location="cpu"))
     return model
 
 
-def predict(model, query, train_data, tokenizer, device, top_k=3):
+def quantize_model(model):
+    # 只量化 Linear 层, 权重 int8, 激活在运行时动态量化. 只能在 CPU 上跑.
+    model.to("cpu")
     model.eval()
-    model.to(device)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized_model(file_path, num_labels, cache: bool = True):
+    """
+    加载量化后的模型缓存: model_file.int8 比 model_file 新就直接用,
+    否则从 fp32 权重量化一次再写回缓存, 下次重启就不用再量化了.
+    cache=False 时不读也不写缓存, 用于马上就会删掉的临时权重文件.
+    """
+    if not cache:
+        return quantize_model(load_model(file_path, num_labels))
+
+    cache_file = file_path + ".int8"
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(
+        file_path
+    ):
+        try:
+            # 只需要结构, 不用加载预训练权重
+            config = DistilBertConfig.from_pretrained(
+                "distilbert-base-uncased", num_labels=num_labels
+            )
+            model = quantize_model(DistilBertForSequenceClassification(config))
+            model.load_state_dict(torch.load(cache_file, map_location="cpu"))
+            log_dbg(f"load quantized model cache: {cache_file}")
+            return model
+        except Exception as e:
+            log_err(f"fail to load quantized model cache: {e}")
+
+    model = quantize_model(load_model(file_path, num_labels))
+
+    tmp_file = cache_file + ".tmp"
+    torch.save(model.state_dict(), tmp_file)
+    os.replace(tmp_file, cache_file)
+    log_info(f"save quantized model cache: {cache_file}")
+    return model
 
+
+def make_train_data(pool: List[dict], slots: List[int]) -> List[dict]:
+    # label 就是记忆所在的槽位, 这样分类头在多次训练之间保持稳定, 可以增量训练.
+    return [{"q": pool[slot]["q"], "label": slot} for slot in slots if pool[slot]]
+
+
+def train_worker(job: dict) -> dict:
+    """
+    训练一次记忆模型并把权重写到 job["output_file"].
+    job: num_labels / train_data / base_file / output_file / epochs / batch_size
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    num_labels = job["num_labels"]
+
+    model = DistilBertForSequenceClassification.from_pretrained(
+        "distilbert-base-uncased", num_labels=num_labels
+    )
+
+    incremental = False
+    base_file = job.get("base_file", "")
+    if base_file and os.path.exists(base_file):
+        state = torch.load(base_file, map_location="cpu")
+        # 记忆大小变了的话分类头对不上, 只能从头训练.
+        if state["classifier.weight"].shape[0] == num_labels:
+            model.load_state_dict(state)
+            incremental = True
+
+    train_data = job["train_data"]
+    epochs = job.get("epochs", 5)
+
+    start = time.time()
+    batch_size = job.get("batch_size", 16)
+    train(model, train_data, epochs=epochs, batch_size=batch_size, device=device)
+    duration = time.time() - start
+
+    model.to("cpu")
+    export_model(model, job["output_file"])
+
+    return {
+        "samples": len(train_data),
+        "epochs": epochs,
+        "batch_size": batch_size,
+        "incremental": incremental,
+        "duration": duration,
+        "throughput": len(train_data) * epochs / duration if duration > 0 else 0,
+    }
+
+
+def train_process(job: dict, conn):
+    # 在独立进程中训练, 不和服务进程抢 GIL 和 CPU.
+    try:
+        conn.send(train_worker(job))
+    except Exception as e:
+        conn.send({"error": str(e)})
+    finally:
+        conn.close()
+
+
+def predict_batch(model, queries, train_data, tokenizer, device, top_k_list):
+    # 一次前向算完整个 batch, 只按 batch 内最长的句子补齐.
     inputs = tokenizer(
-        query, truncation=True, padding="max_length", max_length=32, return_tensors="pt"
+        queries, truncation=True, padding=True, max_length=32, return_tensors="pt"
     )
     input_ids = inputs["input_ids"].to(device)
     attention_mask = inputs["attention_mask"].to(device)
@@ -83,19 +242,111 @@ def predict(model, query, train_data, tokenizer, device, top_k=3):
         logits = model(input_ids, attention_mask=attention_mask).logits
 
     probs = torch.softmax(logits, dim=-1)
-    top_probs, top_labels = torch.topk(probs, top_k, dim=-1)
-
-    result = []
-    for i in range(top_k):
-        result.append(
-            {
-                "q": train_data[top_labels[0, i]]["q"],
-                "a": train_data[top_labels[0, i]]["a"],
-                "prob": top_probs[0, i].item(),
-            }
-        )
+    # 槽位可能是空的, 多取一些再过滤.
+    search_k = min(max(top_k_list) * 2, probs.shape[-1])
+    top_probs, top_labels = torch.topk(probs, search_k, dim=-1)
+    top_probs = top_probs.tolist()
+    top_labels = top_labels.tolist()
+
+    results = []
+    for row, top_k in enumerate(top_k_list):
+        result = []
+        for i in range(search_k):
+            if len(result) >= top_k:
+                break
+            slot = top_labels[row][i]
+            item = train_data[slot] if slot < len(train_data) else None
+            if not item:
+                continue
+            result.append(
+                {
+                    "q": item["q"],
+                    "a": item["a"],
+                    "slot": slot,
+                    "prob": top_probs[row][i],
+                }
+            )
+        results.append(result)
+
+    return results
+
 
-    return result
+def predict(model, query, train_data, tokenizer, device, top_k=3):
+    model.eval()
+    model.to(device)
+
+    return predict_batch(model, [query], train_data, tokenizer, device, [top_k])[0]
+
+
+class BatchPredictor:
+    """
+    把并发的 predict 请求在 batch_wait_ms 内攒成一个 batch 再做一次前向.
+    调用方阻塞等待自己那一行的结果.
+    """
+
+    max_batch_size: int = 8
+    batch_wait_ms: int = 5
+
+    def __init__(self, run_batch, max_batch_size: int = 8, batch_wait_ms: int = 5):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_wait_ms = max(0, batch_wait_ms)
+        self.batch_sizes: Dict[int, int] = {}
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def predict(self, query: str, top_k: int = 3) -> List[dict]:
+        req = {"query": query, "top_k": top_k, "event": threading.Event()}
+        self.__queue.put(req)
+        req["event"].wait()
+        if "error" in req:
+            raise req["error"]
+        return req["result"]
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        queries = sum(size * cnt for size, cnt in self.batch_sizes.items())
+        return {
+            "batches": batches,
+            "queries": queries,
+            "avg_batch_size": queries / batches if batches else 0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+        }
+
+    def __collect(self) -> List[dict]:
+        reqs = [self.__queue.get()]
+        deadline = time.time() + self.batch_wait_ms / 1000
+        while len(reqs) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                reqs.append(self.__queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return reqs
+
+    def __run(self):
+        while True:
+            reqs = self.__collect()
+            size = len(reqs)
+            self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+            log_dbg(f"predict batch size: {size}")
+
+            try:
+                results = self.run_batch(
+                    [req["query"] for req in reqs], [req["top_k"] for req in reqs]
+                )
+                for req, result in zip(reqs, results):
+                    req["result"] = result
+            except Exception as e:
+                for req in reqs:
+                    req["error"] = e
+
+            for req in reqs:
+                req["event"].set()
 
 
 class Transformers:
@@ -106,10 +357,28 @@ class Transformers:
     input_data: List[dict]
     enable: bool = False
     depth: int = 20
-
-    def __init__(self):
-        self.tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
+    predictor: BatchPredictor
+    quantize: bool = False
+    threads: int = 0
+
+    def __init__(
+        self,
+        max_batch_size: int = 8,
+        batch_wait_ms: int = 5,
+        quantize: bool = False,
+        threads: int = 0,
+    ):
+        self.tokenizer = get_tokenizer()
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.input_data = []
+        # int8 动态量化只有 CPU 实现
+        self.quantize = quantize and self.device.type == "cpu"
+        self.threads = threads
+        if threads > 0:
+            # 默认会用满所有核, 会和 web worker 抢 CPU.
+            torch.set_num_threads(threads)
+            log_info(f"set torch threads: {threads}")
+        self.predictor = BatchPredictor(self.__predict_batch, max_batch_size, batch_wait_ms)
 
     def save_model(self, model_file: str) -> bool:
         if not self.enable:
@@ -120,64 +389,74 @@ class Transformers:
         if not ret:
             return False
 
-        return os.rename(tmp_file, model_file)
-
-    def load_model(self, model_file: str):
-        self.model = load_model(model_file)
+        os.replace(tmp_file, model_file)
+        return True
+
+    def load_model(self, model_file: str, input_data: List[dict] = None):
+        if input_data is not None:
+            self.input_data = input_data
+        return self.swap_model(model_file)
+
+    def swap_model(self, model_file: str, cache: bool = True):
+        # 先在旁边加载好新权重, 再一次性替换引用, 正在进行的 predict 不受影响.
+        if self.quantize:
+            model = load_quantized_model(model_file, len(self.input_data), cache)
+        else:
+            model = load_model(model_file, len(self.input_data))
+            model.eval()
+            model.to(self.device)
+        self.model = model
         self.enable = True
-        return self.model
+        return model
 
-    def predict(self, query, predict_limit: int = 3):
-        if not self.enable:
-            return {}
-        # limit over flow
-        if predict_limit >= len(self.input_data):
-            predict_limit = self.input_data - 1
+    def append(self, slot: int, item: dict):
+        # 分类模型只能通过 train 更新, 新记忆由 TrainScheduler 攒够后训练.
+        pass
 
-        return predict(
+    def __predict_batch(self, queries: List[str], top_k_list: List[int]):
+        # 模型在 swap_model 时已经 eval 并放到 device 上了, 这里不用再搬.
+        return predict_batch(
             self.model,
-            query,
+            queries,
             self.input_data,
             self.tokenizer,
             self.device,
-            top_k=predict_limit,
+            top_k_list,
         )
 
+    def predict(self, query, predict_limit: int = 3):
+        if not self.enable:
+            return []
+
+        return self.predictor.predict(query, predict_limit)
+
     def train(self, input_data, depth):
-        if not self.depth:
+        if not depth:
             return None
 
-        import random
-        from tool.util import log_dbg
-
         self.depth = depth
-
-        self.input_data = []
-        # [x for x in input_data if x is not None]
-
-        label = 0
-        while True:
-            iter = random.choice(input_data)
-            if not iter:
-                continue
-            if len(self.input_data) > self.depth:
-                break
-            iter["label"] = label
-            self.input_data.insert(0, iter)
-            label += 1
-
-        log_info("ran count: " + str(label - 1))
-
-        self.model = DistilBertForSequenceClassification.from_pretrained(
-            "distilbert-base-uncased", num_labels=len(input_data)
-        )
-        ret = train(
-            self.model, self.input_data, epochs=5, batch_size=2, device=self.device
-        )
-
-        self.enable = True
-
-        return ret
+        self.input_data = input_data
+
+        slots = [slot for slot, item in enumerate(input_data) if item]
+        slots = random.sample(slots, min(len(slots), depth))
+        log_info("ran count: " + str(len(slots)))
+
+        fd, model_file = tempfile.mkstemp(suffix=".pt")
+        os.close(fd)
+        try:
+            stats = train_worker(
+                {
+                    "num_labels": len(input_data),
+                    "train_data": make_train_data(input_data, slots),
+                    "output_file": model_file,
+                }
+            )
+            # 临时文件马上就删了, 不留量化缓存
+            self.swap_model(model_file, cache=False)
+        finally:
+            os.remove(model_file)
+
+        return stats
 
 
 def transformers_predict(input_data):
@@ -186,7 +465,7 @@ def transformers_predict(input_data):
     print("input: " + str(input_data))
 
     trans = Transformers()
-    trans.train(input_data)
+    trans.train(input_data, 20)
 
     # 示例1
     query = "摸头"
@@ -200,6 +479,56 @@ def transformers_predict(input_data):
     predictions = trans.predict(query)
     print(json.dumps(predictions, indent=2, ensure_ascii=False))
 
+    # 并发请求会被合成一个 batch
+    threads = [
+        threading.Thread(target=trans.predict, args=(query,)) for query in ["摸头", "摸摸耳朵"] * 8
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f"batch stats: {trans.predictor.stats()}")
+
+
+def benchmark_quantize(input_data, rounds: int = 50):
+    # 对比 fp32 和 int8 动态量化的召回准确率和延迟
+    model = DistilBertForSequenceClassification.from_pretrained(
+        "distilbert-base-uncased", num_labels=len(input_data)
+    )
+    tokenizer = get_tokenizer()
+    device = torch.device("cpu")
+    train_data = make_train_data(input_data, range(len(input_data)))
+    train(model, train_data, epochs=5, batch_size=2, device=device)
+    model.eval()
+
+    def state_size(m):
+        fd, tmp_file = tempfile.mkstemp(suffix=".pt")
+        os.close(fd)
+        torch.save(m.state_dict(), tmp_file)
+        size = os.path.getsize(tmp_file)
+        os.remove(tmp_file)
+        return size
+
+    def run(m):
+        hit = 0
+        start = time.time()
+        for _ in range(rounds):
+            for item in train_data:
+                top = predict(m, item["q"], input_data, tokenizer, device, top_k=1)
+                hit += bool(top) and top[0]["slot"] == item["label"]
+        cost = (time.time() - start) / (rounds * len(train_data))
+        return hit / (rounds * len(train_data)), cost
+
+    fp32_acc, fp32_cost = run(model)
+    fp32_size = state_size(model)
+    qmodel = quantize_model(model)
+    int8_acc, int8_cost = run(qmodel)
+    int8_size = state_size(qmodel)
+
+    print(f"threads: {torch.get_num_threads()}")
+    print(f"fp32: top1 {fp32_acc:.3f}, {fp32_cost * 1000:.2f} ms/query, {fp32_size / 2**20:.1f} MB")
+    print(f"int8: top1 {int8_acc:.3f}, {int8_cost * 1000:.2f} ms/query, {int8_size / 2**20:.1f} MB")
+
 
 def test_predict(input_data):
     import json
@@ -207,7 +536,7 @@ def test_predict(input_data):
     model = DistilBertForSequenceClassification.from_pretrained(
         "distilbert-base-uncased", num_labels=len(input_data)
     )
-    tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
+    tokenizer = get_tokenizer()
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     train(model, input_data, epochs=5, batch_size=2, device=device)
@@ -244,4 +573,6 @@ if __name__ == "__main__":
 
     # test_predict(input_data)
 
+    # benchmark_quantize(input_data)
+
     transformers_predict(input_data)
@@ -88,6 +88,23 @@ def log_dbg(message: str, is_plugin: bool = False):
     # import traceback
     # traceback.print_stack()
 
+
+def log_set_level(level: str):
+    # 按配置调整日志级别, 不是 debug 的时候 log_dbg_enable 才会是 False
+    global __log_disable
+    if __log_disable:
+        return None
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+
+def log_dbg_enable() -> bool:
+    # 拼调试日志本身很贵的时候先判断一下
+    global __log_disable
+    if __log_disable:
+        return False
+    return logger.isEnabledFor(logging.DEBUG)
+
+
 def log_info(message: str, is_plugin: bool = False):
     global __log_disable
     if __log_disable:
@@ -0,0 +1,330 @@
+import os
+import time
+import threading
+import zlib
+import numpy as np
+from typing import Any, List, Optional
+
+from tool.util import log_dbg, log_err, log_info
+from tool.ivf_index import IVFIndex
+
+
+class HashEmbedder:
+    """
+    把文本的字符 n-gram 哈希到固定维度的向量里.
+    不需要加载模型, 也不需要训练, 对中文短句也有效.
+    """
+
+    dim: int = 256
+    ngram: List[int] = [1, 2, 3]
+
+    def __init__(self, dim: int = 256, ngram: List[int] = None):
+        self.dim = dim
+        self.ngram = ngram if ngram else [1, 2, 3]
+
+    def embed(self, text: str) -> np.ndarray:
+        vec = np.zeros(self.dim, dtype=np.float32)
+        if not text:
+            return vec
+
+        text = text.lower()
+        for n in self.ngram:
+            for i in range(len(text) - n + 1):
+                h = zlib.crc32(text[i : i + n].encode("utf-8"))
+                # 最高位决定符号, 减少哈希冲突带来的偏差
+                vec[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+
+        norm = np.linalg.norm(vec)
+        if norm > 0:
+            vec /= norm
+        return vec
+
+
+def fingerprint(item: dict) -> int:
+    # 文本指纹, 0 表示空槽位
+    text = item.get("q", "") + "\0" + item.get("a", "")
+    return zlib.crc32(text.encode("utf-8")) | 1
+
+
+class EmbeddingStore:
+    """
+    按槽位保存向量的内存映射文件 (.npy), 重启时直接映射, 不用重新编码.
+    keys 保存每个槽位文本的指纹, 只有指纹对不上的槽位才需要重新编码.
+    """
+
+    def __init__(self, file: str, size: int, dim: int, dtype: str = "float32"):
+        self.vec_file = file + ".npy"
+        self.key_file = file + ".key.npy"
+
+        path = os.path.dirname(self.vec_file)
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+        self.matrix = self.__open(self.vec_file, (size, dim), np.dtype(dtype))
+        self.keys = self.__open(self.key_file, (size,), np.dtype(np.uint32))
+        if self.matrix.shape != (size, dim) or self.keys.shape != (size,):
+            raise Exception(f"embedding store shape mismatch: {file}")
+
+    @staticmethod
+    def __open(file: str, shape, dtype) -> np.ndarray:
+        if os.path.exists(file):
+            try:
+                arr = np.lib.format.open_memmap(file, mode="r+")
+                if arr.shape == shape and arr.dtype == dtype:
+                    return arr
+                log_info(f"embedding store changed, recreate: {file}")
+                del arr
+            except Exception as e:
+                log_err(f"fail to map embedding store: {e}, recreate: {file}")
+        return np.lib.format.open_memmap(file, mode="w+", dtype=dtype, shape=shape)
+
+    def flush(self):
+        self.matrix.flush()
+        self.keys.flush()
+
+
+class VectorRecall:
+    """
+    向量召回: 每次 append 时把 q/a 编码成向量写进矩阵对应的槽位,
+    召回时只需要一次矩阵乘法 + top-k, 不需要重新训练.
+    """
+
+    name: str = "vector"
+    enable: bool = False
+    size: int = 1024
+    count: int = 0
+    answer_weight: float = 0.5
+    ann_min: int = 20000
+    embedder: HashEmbedder
+    matrix: np.ndarray
+    keys: np.ndarray
+    valid: np.ndarray
+    items: List[Optional[dict]]
+    index: Optional[IVFIndex] = None
+
+    def __init__(
+        self,
+        size: int = 1024,
+        dim: int = 256,
+        store_file: str = "",
+        dtype: str = "float32",
+        ann_min: int = 20000,
+        nprobe: int = 16,
+    ):
+        self.size = size
+        self.dim = dim
+        self.embedder = HashEmbedder(dim)
+        self.store = None
+        self.store_file = store_file
+        self.ann_min = ann_min
+        self.nprobe = nprobe
+        self.index = None
+        if store_file:
+            self.store = EmbeddingStore(store_file, size, dim, dtype)
+            self.matrix = self.store.matrix
+            self.keys = self.store.keys
+        else:
+            self.matrix = np.zeros((size, dim), dtype=dtype)
+            self.keys = np.zeros(size, dtype=np.uint32)
+        self.valid = np.zeros(size, dtype=bool)
+        self.items = [None] * size
+        self.lock = threading.Lock()
+
+    def embed_item(self, item: dict) -> np.ndarray:
+        vec = self.embedder.embed(item.get("q", ""))
+        vec += self.answer_weight * self.embedder.embed(item.get("a", ""))
+        norm = np.linalg.norm(vec)
+        if norm > 0:
+            vec /= norm
+        return vec
+
+    def append(self, slot: int, item: dict):
+        if slot < 0 or slot >= self.size:
+            return
+        vec = self.embed_item(item)
+        with self.lock:
+            self.matrix[slot] = vec
+            self.keys[slot] = fingerprint(item)
+            if not self.valid[slot]:
+                self.count += 1
+            self.valid[slot] = True
+            self.items[slot] = item
+            self.enable = True
+            if self.index:
+                self.index.add(slot, vec)
+            elif self.count >= self.ann_min:
+                self.__build_index()
+
+    def train(self, input_data: List[Optional[dict]], depth: int = 0):
+        # 向量召回不需要训练, 这里按槽位对齐向量: 指纹没变的直接复用映射进来的向量.
+        start = time.time()
+        items: List[Optional[dict]] = [None] * self.size
+        valid = np.zeros(self.size, dtype=bool)
+        changed = []
+
+        for slot, item in enumerate(input_data[: self.size]):
+            if not item or not item.get("q") or not item.get("a"):
+                if self.keys[slot]:
+                    self.keys[slot] = 0
+                    changed.append(slot)
+                continue
+            key = fingerprint(item)
+            if self.keys[slot] != key:
+                self.matrix[slot] = self.embed_item(item)
+                self.keys[slot] = key
+                changed.append(slot)
+            valid[slot] = True
+            items[slot] = item
+
+        with self.lock:
+            self.valid = valid
+            self.items = items
+            self.count = int(valid.sum())
+            self.enable = True
+            if self.count >= self.ann_min:
+                self.__load_index(changed)
+
+        log_info(
+            f"build vector recall done: {self.count}/{self.size}, "
+            f"encode: {len(changed)}, cost: {time.time() - start:.2f}s"
+        )
+
+    def __index_file(self) -> str:
+        return self.store_file + ".ivf.npz" if self.store_file else ""
+
+    def __load_index(self, changed: List[int]):
+        index = IVFIndex(self.size, self.dim, self.nprobe)
+        index_file = self.__index_file()
+        if not index_file or not index.load(index_file):
+            self.__build_index()
+            return
+
+        # 索引只在压缩快照时保存, 之后写入的槽位向量已经在映射文件里了, 但索引里没有或者是旧的:
+        # 有效但没分簇的, 指纹和保存索引时不一样的, 已经清空但还在簇里的, 都要重新加.
+        stale = self.valid & (index.assign < 0)
+        stale |= ~self.valid & (index.assign >= 0)
+        if index.keys is not None:
+            stale |= index.keys != self.keys
+        else:
+            stale[changed] = True
+
+        update = np.flatnonzero(stale)
+        for slot in update:
+            if self.valid[slot]:
+                index.add(slot, np.asarray(self.matrix[slot], dtype=np.float32))
+            else:
+                index.remove(slot)
+        self.index = index
+        log_dbg(f"load ivf index: {index_file}, update: {len(update)}")
+
+    def __build_index(self, sample_size: int = 65536):
+        start = time.time()
+        slots = np.flatnonzero(self.valid)
+        nlist = IVFIndex.suggest_nlist(len(slots))
+        sample_size = min(len(slots), max(sample_size, 32 * nlist))
+        sample = np.sort(np.random.default_rng(0).choice(slots, sample_size, replace=False))
+
+        index = IVFIndex(self.size, self.dim, self.nprobe)
+        index.train(self.matrix[sample], nlist)
+        index.build(self.matrix, slots)
+        self.index = index
+        log_info(f"build ivf index: nlist {nlist}, cost: {time.time() - start:.2f}s")
+
+    def predict(self, query: str, predict_limit: int = 3) -> List[dict]:
+        if not self.enable:
+            return []
+
+        qv = self.embedder.embed(query)
+        with self.lock:
+            if not self.count or predict_limit <= 0:
+                return []
+
+            if self.index:
+                top, scores = self.index.search(self.matrix, qv, predict_limit)
+            else:
+                scores = np.asarray(self.matrix, dtype=np.float32) @ qv
+                scores[~self.valid] = -np.inf
+
+                top_k = min(predict_limit, self.count)
+                top = np.argpartition(-scores, top_k - 1)[:top_k]
+                top = top[np.argsort(-scores[top])]
+                scores = scores[top]
+
+            result = []
+            for slot, score in zip(top, scores):
+                item = self.items[slot]
+                if not item:
+                    continue
+                result.append(
+                    {
+                        "q": item["q"],
+                        "a": item["a"],
+                        "slot": int(slot),
+                        "prob": float(score),
+                    }
+                )
+
+        log_dbg(f"vector recall: {len(result)}")
+        return result
+
+    def save_model(self, model_file: str = "") -> bool:
+        # 向量已经在映射文件里了, 只需要刷盘, 再把倒排索引存下来.
+        if not self.store:
+            return True
+        with self.lock:
+            self.store.flush()
+            if self.index:
+                self.index.save(self.__index_file(), np.array(self.keys))
+        return True
+
+    def load_model(self, model_file: str) -> Any:
+        return self
+
+
+def benchmark_ann(counts: List[int] = None, dim: int = 256, k: int = 10):
+    # 对比 IVF 和暴力搜索: recall@k 和单次查询延迟
+    if not counts:
+        counts = [10000, 100000, 1000000]
+    rng = np.random.default_rng(0)
+    queries = 100
+    for count in counts:
+        # 造一些有簇结构的数据, 更接近真实文本向量
+        centers = rng.standard_normal((max(16, count // 500), dim)).astype(np.float32)
+        matrix = centers[rng.integers(len(centers), size=count)]
+        matrix += 0.6 * rng.standard_normal((count, dim)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        query = matrix[rng.choice(count, queries, replace=False)]
+        query = query + 0.3 * rng.standard_normal(query.shape).astype(np.float32)
+        query /= np.linalg.norm(query, axis=1, keepdims=True)
+
+        start = time.time()
+        index = IVFIndex(count, dim)
+        slots = np.arange(count)
+        index.train(matrix[rng.choice(count, min(count, 65536), replace=False)], IVFIndex.suggest_nlist(count))
+        index.build(matrix, slots)
+        build_cost = time.time() - start
+
+        start = time.time()
+        exact = []
+        for q in query:
+            scores = matrix @ q
+            exact.append(set(np.argpartition(-scores, k - 1)[:k].tolist()))
+        brute_cost = (time.time() - start) / queries
+
+        for nprobe in [4, 8, 16, 32]:
+            start = time.time()
+            hit = 0
+            for q, truth in zip(query, exact):
+                ids, _ = index.search(matrix, q, k, nprobe)
+                hit += len(truth & set(ids.tolist()))
+            cost = (time.time() - start) / queries
+            print(
+                f"n={count} nlist={index.nlist} nprobe={nprobe}: recall@{k} {hit / (k * queries):.3f}, "
+                f"{cost * 1000:.2f} ms/query (brute {brute_cost * 1000:.2f} ms, build {build_cost:.1f}s)"
+            )
+
+
+if __name__ == "__main__":
+    import sys
+
+    benchmark_ann([int(n) for n in sys.argv[1:]])